@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import json
+import hashlib
+import logging
+from .store import atomic_write
+
+package_path = os.path.split(__file__)[0]
+
+
+def code_version():
+    """
+    sha256 of the python sources of the package
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(package_path)):
+        if name.endswith(".py"):
+            with open(os.path.join(package_path, name), "rb") as f:
+                digest.update(name.encode())
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def file_fingerprint(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def bam_index(bamfile):
+    for index in [bamfile + ".bai", bamfile[:-4] + ".bai", bamfile + ".csi"]:
+        if os.path.exists(index):
+            return index
+    return None
+
+
+def stage_manifest(inputs, params):
+    """
+    cache manifest of a stage: fingerprints of its input files, its parameters and the
+    code version, with a key addressing their content
+    """
+    manifest = {"inputs": [file_fingerprint(f) for f in inputs if f is not None and os.path.exists(f)],
+                "params": params,
+                "version": code_version()}
+    manifest["key"] = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+    return manifest
+
+
+def manifest_file(output, stage):
+    return os.path.join(output, "temp/cache", "{}.json".format(stage))
+
+
+def manifest_key(path):
+    try:
+        with open(path) as f:
+            return json.load(f).get("key")
+    except (OSError, ValueError):
+        return None
+
+
+def manifest_write(path, manifest):
+    def write(tmp):
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, sort_keys=True, indent=1)
+    atomic_write(path, write)
+
+
+def stage_key(output, stage):
+    """
+    key of the last completed run of a stage, or None
+    """
+    return manifest_key(manifest_file(output, stage))
+
+
+def stage_params(output, stage):
+    """
+    parameters of the last completed run of a stage, or an empty dict
+    """
+    try:
+        with open(manifest_file(output, stage)) as f:
+            return json.load(f).get("params", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def stage_cached(output, stage, manifest, outputs_exist=True):
+    """
+    whether a stage has completed with the same inputs, parameters and code version
+    and its outputs are still in place
+    """
+    if not outputs_exist or stage_key(output, stage) != manifest["key"]:
+        return False
+    logging.getLogger('metaMIC').info("Stage {} is up to date".format(stage))
+    return True
+
+
+def stage_start(output, stage, outputs=()):
+    """
+    forget the last completed run of a stage about to be recomputed and remove the files
+    and directories in outputs, so that an interrupted run never leaves results that look
+    complete
+    """
+    for path in [manifest_file(output, stage)] + list(outputs):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def stage_done(output, stage, manifest):
+    """
+    record the manifest of a completed stage
+    """
+    os.makedirs(os.path.join(output, "temp/cache"), exist_ok=True)
+    manifest_write(manifest_file(output, stage), manifest)
+
+
+def checkpoint_path(output, stage):
+    return os.path.join(output, "temp/checkpoint", stage)
+
+
+def stage_checkpoint(output, stage, manifest):
+    """
+    directory of the per-contig checkpoint store of a stage, emptied when it holds
+    results computed from other inputs, parameters or code version than manifest;
+    parameters that only select contigs, such as min_length, are left out of manifest
+    so that results of contigs already done are reused
+    """
+    path = checkpoint_path(output, stage)
+    if manifest_key(os.path.join(path, "manifest.json")) != manifest["key"]:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        manifest_write(os.path.join(path, "manifest.json"), manifest)
+    return path
@@ -10,6 +10,11 @@ import warnings
 import pysam
 import collections
 import multiprocessing
+try:
+    from .window import window_starts, window_mean, window_var
+except ImportError:
+    # run as a script, the package directory itself is on sys.path
+    from window import window_starts, window_mean, window_var
 
 def parseargs():
     parser=argparse.ArgumentParser(description="Calculate coverage/fragment coverage of assemblies")
@@ -24,21 +29,13 @@ def window_coverage_cal(args,coverage):
     """
     Using sliding window approach to smooth out features
     """
+    starts = window_starts(len(coverage))
+    moving_sum_array = window_mean(coverage,starts)
+    moving_dev_array = np.sqrt(window_var(coverage,starts))/moving_sum_array
     cov = {}
-    moving_sum_array = []
-    moving_dev_array = []
-    pos  = []
-    for i in range(300,len(coverage),100):
-        start=i
-        end = i + 100
-        moving_sum_array.append(np.mean(coverage[start:end]))
-        moving_dev_array.append(np.sqrt(np.var(coverage[start:end]))/np.mean(coverage[start:end]))
-        pos.append(start)
-        if len(coverage) - end <= 300:
-            break
     cov["coverage"] = moving_sum_array
     cov["deviation"] = moving_dev_array
-    cov["pos"]=pos
+    cov["pos"]=list(starts)
     return cov
 
 def depthparse(args):
@@ -71,7 +68,7 @@ def depthparse(args):
         depth_dict["depth"].append(int(line.strip().split()[2]))
         previous_contig=contig
     data=pd.DataFrame(cov_dict)
-    os.makedirs(os.path.join(args.output, "temp/coverage/"))
+    os.makedirs(os.path.join(args.output, "temp/coverage/"), exist_ok=True)
     data.to_csv(os.path.join(args.output, "temp/coverage/coverage.txt"),sep="\t")
     return data
 
@@ -15,262 +15,488 @@ import pysam
 import collections
 import warnings
 import math
-import re
-from Bio import SeqIO
+import logging
+from functools import partial
+from .window import window_starts, window_sum, window_mean, window_var, coverage_track
+from .kmer import kmer_scan, kmer_count, kmer_lookup, group_unique, kmer_group_count, \
+    kmer_sketch, sketch_query, kmer_dump_read
+from .store import feature_exists, feature_discard, feature_write, base_store_exists, base_store_write, atomic_write, savez_atomic, \
+    contig_store_done, contig_store_part, contig_store_log, contig_store_append, contig_store_read
+from .cache import bam_index, stage_manifest, stage_key, stage_cached, stage_start, stage_done, checkpoint_path, stage_checkpoint
 
-base_path = os.path.split(__file__)[0]
 
-def fragment_distribution(samfile):
-    all_reads = samfile.fetch()
+def fragment_distribution(samfile, sample_pairs=0):
+    """
+    histogram of fragment sizes of reads with mates on the same contig;
+    with sample_pairs, stop after that many read pairs drawn across all contigs
+    """
     size_freq = collections.defaultdict(int)
-    for read in all_reads:
-        if read.rnext == read.tid and read.is_paired:
-            size = abs(read.isize)
-            size_freq[size] += 1
+    if sample_pairs <= 0:
+        for read in samfile.fetch():
+            if read.rnext == read.tid and read.is_paired:
+                size = abs(read.isize)
+                size_freq[size] += 1
+        return size_freq
+
+    total_length = sum(samfile.lengths)
+    num_pairs = 0
+    for ref, lens in zip(samfile.references, samfile.lengths):
+        quota = math.ceil(sample_pairs * lens / total_length)
+        contig_pairs = 0
+        for read in samfile.fetch(ref):
+            if read.rnext == read.tid and read.is_paired and read.is_read1:
+                # both mates are counted in the full scan
+                size_freq[abs(read.isize)] += 2
+                contig_pairs += 1
+                if contig_pairs >= quota:
+                    break
+        num_pairs += contig_pairs
+        if num_pairs >= sample_pairs:
+            break
     return size_freq
 
 
+def weighted_median(values, counts):
+    """
+    median of values each repeated counts times
+    """
+    if len(values) == 0 or np.sum(counts) == 0:
+        return np.nan
+    order = np.argsort(values)
+    values = values[order]
+    cum_counts = np.cumsum(counts[order])
+    total = cum_counts[-1]
+    lower = values[np.searchsorted(cum_counts, (total - 1) // 2, side='right')]
+    upper = values[np.searchsorted(cum_counts, total // 2, side='right')]
+    return (lower + upper) / 2
+
+
 def FragMAD(freq):
     """
     calculate median and median absolute deviation fragment size distribution
     """
-    all_size = []
-    for key, value in freq.items():
-        all_size.extend([key] * int(value))
-    median_size = np.median(all_size)
-    residuals = abs(np.array(all_size) - median_size)
-    mad_size = 1.4826 * np.median(residuals)
+    sizes = np.array(list(freq.keys()), dtype=float)
+    counts = np.array(list(freq.values()), dtype=np.int64)
+    median_size = weighted_median(sizes, counts)
+    residuals = np.abs(sizes - median_size)
+    mad_size = 1.4826 * weighted_median(residuals, counts)
     return median_size, mad_size
 
 
+def assembly_index(assemblies):
+    """
+    (re)build the faidx index of the assembly if it is missing or older than the assembly
+    """
+    if not os.path.exists(assemblies + ".fai") or \
+            os.path.getmtime(assemblies + ".fai") < os.path.getmtime(assemblies):
+        pysam.faidx(assemblies)
+
+
+def assembly_inputs(args):
+    return [args.bamfile, bam_index(args.bamfile), args.assemblies, args.assemblies + ".fai"]
+
+
+def fragment_size_cal(args):
+    """
+    median and MAD of the fragment size distribution, cached in the output directory
+    """
+    size_file = os.path.join(args.output, "temp/read_feature/fragment_size.txt")
+    manifest = stage_manifest([args.bamfile, bam_index(args.bamfile)],
+                              {"sample_pairs": args.sample_pairs})
+    if stage_cached(args.output, "fragment_size", manifest, os.path.exists(size_file)):
+        size_data = pd.read_csv(size_file, sep="\t", index_col=0, float_precision='round_trip')
+        return float(size_data.loc[0, 'median_size']), float(size_data.loc[0, 'mad_size'])
+    stage_start(args.output, "fragment_size", [size_file])
+
+    samfile = pysam.AlignmentFile(args.bamfile, "rb")
+    size_freq = fragment_distribution(samfile, args.sample_pairs)
+    mu, dev = FragMAD(size_freq)
+    size_data = pd.DataFrame({"bamfile": [os.path.abspath(args.bamfile)],
+                              "sample_pairs": [args.sample_pairs],
+                              "median_size": [mu],
+                              "mad_size": [dev]})
+    atomic_write(size_file, lambda tmp: size_data.to_csv(tmp, sep="\t", float_format="%.17g"))
+    stage_done(args.output, "fragment_size", manifest)
+    return mu, dev
+
+
+def contig_blocks(references, lengths, min_length, parts, done=()):
+    """
+    split contigs not done yet into blocks of consecutive references with similar total length
+    """
+    contigs = [(ref, lens) for ref, lens in zip(references, lengths) if lens >= min_length and ref not in done]
+    block_size = sum(lens for ref, lens in contigs) / max(parts, 1)
+    blocks = []
+    block = []
+    size = 0
+    for ref, lens in contigs:
+        block.append(ref)
+        size += lens
+        if size >= block_size:
+            blocks.append(block)
+            block = []
+            size = 0
+    if block:
+        blocks.append(block)
+    return blocks
+
+
 def split_sam(args):
-    split_command = ' '.join(['sh',
-                              os.path.join(base_path, "split_sam.sh"),
-                              args.assemblies,
-                              args.bamfile,
-                              args.output,
-                              args.samtools])
-    os.system(split_command)
-
-
-def seq_parse(args):
-    input = SeqIO.parse(args.assemblies, "fasta")
-    contig_seqs = {}
-    for record in input:
-        if len(record.seq) >= args.min_length:
-            contig_seqs[record.id] = str(record.seq)
-    return contig_seqs
-
-
-def kmer_parse(seq, pool):
-    seq_kmer = {"position": [], "KAD": []}
-    for i in range(len(seq)):
-        if seq[i:(i + 25)] in pool:
-            seq_kmer["KAD"].append(pool[seq[i:(i + 25)]])
-            seq_kmer["position"].append(i + 1)
-        if (i + 25) >= len(seq):
-            break
+    """
+    partition the contig sequences and the reads with mates on the same contig into
+    per-shard containers, fetching each contig from the indexed bam file once in reference
+    order; shards are kept in a checkpoint store so that only contigs not split by an
+    earlier run are fetched, and the shards of this run are listed in temp/split/shard_list.txt
+    """
+    split_dir = os.path.join(args.output, "temp/split")
+    shard_list = os.path.join(split_dir, "shard_list.txt")
+    manifest = stage_manifest(assembly_inputs(args),
+                              {"min_length": args.min_length, "threads": args.threads})
+    if stage_cached(args.output, "split", manifest, os.path.exists(shard_list)):
+        return 0
+    stage_start(args.output, "split", [shard_list])
+    os.makedirs(split_dir, exist_ok=True)
+    checkpoint = stage_checkpoint(args.output, "split", stage_manifest(assembly_inputs(args), {}))
+    samfile = pysam.AlignmentFile(args.bamfile, "rb")
+    fastafile = pysam.FastaFile(args.assemblies)
+    for block in contig_blocks(samfile.references, samfile.lengths, args.min_length,
+                               args.threads * 8, contig_store_done(checkpoint)):
+        seqs = []
+        reads = []
+        contig_read = [0]
+        for contig in block:
+            seqs.append(fastafile.fetch(contig).encode())
+            for read in samfile.fetch(contig):
+                if read.next_reference_id == read.reference_id and read.query_sequence is not None:
+                    reads.append(read.query_sequence.encode())
+            contig_read.append(len(reads))
+        part = contig_store_part()
+        savez_atomic(os.path.join(checkpoint, "shard_{}.npz".format(part)),
+                     contig=np.array(block),
+                     seq=np.frombuffer(b''.join(seqs), dtype=np.uint8),
+                     seq_offset=np.cumsum([0] + [len(seq) for seq in seqs]),
+                     read=np.frombuffer(b''.join(reads), dtype=np.uint8),
+                     read_offset=np.cumsum([0] + [len(read) for read in reads]),
+                     contig_read=np.array(contig_read))
+        contig_store_log(checkpoint, block, part)
+
+    # shards holding the contigs of this run, including those split by earlier runs
+    done = contig_store_done(checkpoint)
+    shard_files = []
+    for ref, lens in zip(samfile.references, samfile.lengths):
+        shard_file = os.path.join(checkpoint, "shard_{}.npz".format(done.get(ref)))
+        if lens >= args.min_length and ref in done and shard_file not in shard_files:
+            shard_files.append(shard_file)
+
+    def write(tmp):
+        with open(tmp, "w") as f:
+            f.write("".join("{}\n".format(shard_file) for shard_file in shard_files))
+    atomic_write(shard_list, write)
+    stage_done(args.output, "split", manifest)
+
+
+def shard_reads(read, read_offset, start, end):
+    """
+    read sequences start to end of a shard container, decoded one at a time
+    """
+    for j in range(start, end):
+        yield read[read_offset[j]:read_offset[j + 1]].tobytes().decode()
+
+
+def shard_contigs(shard_file):
+    """
+    contig name, sequence and read sequences of every contig in a shard container;
+    the reads are a generator, so they can be consumed without holding them all
+    """
+    shard = np.load(shard_file)
+    seq = shard["seq"]
+    seq_offset = shard["seq_offset"]
+    read = shard["read"]
+    read_offset = shard["read_offset"]
+    contig_read = shard["contig_read"]
+    for i, contig in enumerate(shard["contig"]):
+        reads = shard_reads(read, read_offset, contig_read[i], contig_read[i + 1])
+        yield str(contig), seq[seq_offset[i]:seq_offset[i + 1]].tobytes().decode(), reads
+
+
+def KAD_file(args, contig):
+    return os.path.join(checkpoint_path(args.output, "KAD"), "KAD_data", "{}.npz".format(str(contig)))
+
+
+def kmer_parse(seq, pool_kmer, pool_KAD):
+    """
+    positions (1-based) and KAD values of the contig k-mers found in the sorted KAD pool
+    """
+    kmers, valid = kmer_scan(seq)
+    index, found = kmer_lookup(kmers, valid, pool_kmer)
+    seq_kmer = {"position": np.flatnonzero(found) + 1,
+                "KAD": pool_KAD[index[found]]}
     return seq_kmer
 
 
 def KAD_window_cal(seq_kmer):
-    KAD_window_dict = {"start_pos": [],
-                       "mean_KAD": [],
-                       "abnormal_KAD_ratio": [],
-                       "dev_KAD": []}
-
-    for i in range(300, len(seq_kmer['position']), 100):
-        KAD_window_dict["start_pos"].append(i)
-        mean_KAD = np.mean(np.abs(seq_kmer['KAD'][i:i + 100]))
-        KAD_window_dict["mean_KAD"].append(mean_KAD)
-        KAD_window_dict["abnormal_KAD_ratio"].append(
-            np.sum(np.abs(seq_kmer['KAD'][i:i + 100]) > 0.5) / 100)
-        KAD_window_dict["dev_KAD"].append(
-            np.sqrt(np.var(np.abs(seq_kmer['KAD'][i:i + 100]))))
+    KAD = np.abs(seq_kmer['KAD'])
+    starts = window_starts(len(seq_kmer['position']), tail=False)
+    KAD_window_dict = {"start_pos": list(starts),
+                       "mean_KAD": window_mean(KAD, starts),
+                       "abnormal_KAD_ratio": window_sum(KAD > 0.5, starts) / 100,
+                       "dev_KAD": np.sqrt(window_var(KAD, starts))}
     return KAD_window_dict
 
 
-def KAD_feature(args):
-    seq_data = seq_parse(args)
-    KAD_dict = {"contig": [],
-                'start_pos': [],
-                'mean_KAD': [],
-                'abnormal_KAD_ratio': [],
-                'dev_KAD': []}
-    for contig, seq in seq_data.items():
-        if len(seq) < args.min_length:
-            continue
-        if os.path.exists(os.path.join(args.output, "temp/KAD/KAD_data/",
-                                                    "{}.KAD".format(str(contig)))):
-            try:
-                KAD_data = pd.read_csv(os.path.join(args.output, "temp/KAD/KAD_data/",
-                                                    "{}.KAD".format(str(contig))), index_col=0, sep="\t")
-                KAD_data = KAD_data.drop_duplicates(['k-mer'])
-            except BaseException:
-                continue
-            KAD_data.index = KAD_data['k-mer']
-            KAD_pool = KAD_data.loc[:, 'KAD'].to_dict()
-            seq_kmer = kmer_parse(seq, KAD_pool)
-            KAD_window = KAD_window_cal(seq_kmer)
-            KAD_dict["contig"].extend([contig] * len(KAD_window['start_pos']))
-            KAD_dict["start_pos"].extend(KAD_window['start_pos'])
-            KAD_dict["mean_KAD"].extend(KAD_window["mean_KAD"])
-            KAD_dict["abnormal_KAD_ratio"].extend(
-                KAD_window["abnormal_KAD_ratio"])
-            KAD_dict["dev_KAD"].extend(KAD_window["dev_KAD"])
-    return KAD_dict
-
-
-def KAD(args, contig, file):
-    if os.path.exists(os.path.join(args.output, "temp/KAD/KAD_data/",
-                                   str(contig), ".KAD")):
-        return 0
-    contig_file = os.path.join(args.output, "temp/split/contigs/", "{}.fa".format(file))
-
-    read_file = os.path.join(args.output,
-                             "temp/split/reads/{}.read.fa".format(str(contig)))
-    # kmer count
-    outputdir = os.path.join(args.output, "temp/KAD/temp")
-    contig_command1 = ' '.join([args.jellyfish,
-                                "count -m 25 -o",
-                                os.path.join(outputdir, '{}.jf'.format(str(contig))),
-                                "-s 100M -t 8",
-                                contig_file])
-    contig_command2 = ' '.join([args.jellyfish,
-                                "dump -c -t -o",
-                                os.path.join(outputdir, '{}_count.txt'.format(str(contig))),
-                                os.path.join(outputdir, '{}.jf'.format(str(contig)))])
-    os.system(contig_command1)
-    os.system(contig_command2)
-    read_command1 = ' '.join([args.jellyfish,
-                              "count -m 25 -o",
-                              os.path.join(outputdir, '{}.read.jf'.format(str(contig))),
-                              "-s 100M -t 8",
-                              read_file])
-    read_command2 = ' '.join([args.jellyfish,
-                              "dump -c -t -o",
-                              os.path.join(outputdir, '{}_count.read.txt'.format(str(contig))),
-                              os.path.join(outputdir, '{}.read.jf'.format(str(contig)))])
-    os.system(read_command1)
-    os.system(read_command2)
-    assembly_kmer = pd.read_csv(os.path.join(args.output, "temp/KAD/temp/",
-                                             "{}_count.txt".format(str(contig))), sep="\t", header=None)
-    assembly_kmer.index = assembly_kmer[0]
+def KAD_window_init():
+    return {"contig": [],
+            'start_pos': [],
+            'mean_KAD': [],
+            'abnormal_KAD_ratio': [],
+            'dev_KAD': []}
 
+
+def KAD_window_add(args, KAD_dict, contig, seq):
+    """
+    add the window-based KAD features of a contig with a KAD table to KAD_dict
+    """
+    if not os.path.exists(KAD_file(args, contig)):
+        return
     try:
-        read_kmer = pd.read_csv(os.path.join(args.output, "temp/KAD/temp/",
-                                             "{}_count.read.txt".format(str(contig))),
-                                             sep="\t", header=None)
-        read_kmer.index = read_kmer[0]
+        KAD_data = np.load(KAD_file(args, contig))
+        seq_kmer = kmer_parse(seq, KAD_data["kmer"], KAD_data["KAD"])
     except BaseException:
+        return
+    KAD_window = KAD_window_cal(seq_kmer)
+    KAD_dict["contig"].extend([contig] * len(KAD_window['start_pos']))
+    KAD_dict["start_pos"].extend(KAD_window['start_pos'])
+    KAD_dict["mean_KAD"].extend(KAD_window["mean_KAD"])
+    KAD_dict["abnormal_KAD_ratio"].extend(
+        KAD_window["abnormal_KAD_ratio"])
+    KAD_dict["dev_KAD"].extend(KAD_window["dev_KAD"])
+
+
+def kmer_KAD(assembly_kmer, assembly_count, read_kmer, read_count):
+    """
+    KAD of every k-mer of a contig or its reads, with the k-mer depth taken as the most
+    frequent read count of single-copy contig k-mers; None if no depth can be estimated
+    """
+    kmers = np.union1d(assembly_kmer, read_kmer)
+    assembly = np.zeros(len(kmers))
+    assembly[np.searchsorted(kmers, assembly_kmer)] = assembly_count
+    read = np.zeros(len(kmers))
+    read[np.searchsorted(kmers, read_kmer)] = read_count
+    shared = (assembly == 1) & (read > 0)
+    depth_pool = read[shared] if shared.any() else read[read > 5]
+    if len(depth_pool) == 0:
+        return None
+    values, freq = np.unique(depth_pool, return_counts=True)
+    kmer_depth = values[np.argmax(freq)]
+    KAD = np.log2((read + kmer_depth) / (kmer_depth * (assembly + 1)))
+    keep = ~((read == 1) & (assembly == 0))
+    return kmers[keep], KAD[keep]
+
+
+def kmer_group_KAD(assembly, read):
+    """
+    KAD of the (contig, k-mer) pairs of many contigs at once, as kmer_KAD computes it for
+    one contig, from the sorted (contig, k-mer, count) arrays of contigs and reads
+    """
+    groups = np.concatenate([assembly[0], read[0]])
+    kmers = np.concatenate([assembly[1], read[1]])
+    order = np.lexsort((kmers, groups))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (groups[order][1:] != groups[order][:-1]) | (kmers[order][1:] != kmers[order][:-1])
+    index = np.empty(len(order), dtype=np.int64)
+    index[order] = np.cumsum(first) - 1
+    groups = groups[order][first]
+    kmers = kmers[order][first]
+    assembly_count = np.zeros(len(kmers))
+    assembly_count[index[:len(assembly[0])]] = assembly[2]
+    read_count = np.zeros(len(kmers))
+    read_count[index[len(assembly[0]):]] = read[2]
+
+    # k-mer depth of a contig: most frequent read count of its single-copy contig k-mers
+    # shared with reads, or of its read k-mers seen more than 5 times if there are none
+    shared = (assembly_count == 1) & (read_count > 0)
+    ngroups = int(groups.max()) + 1 if len(groups) > 0 else 0
+    has_shared = np.bincount(groups[shared], minlength=ngroups) > 0
+    depth_pool = shared | (~has_shared[groups] & (read_count > 5))
+    pool_group, pool_count, pool_freq = group_unique(groups[depth_pool], read_count[depth_pool],
+                                                     np.ones(int(depth_pool.sum()), dtype=np.int64))
+    mode = np.lexsort((pool_count, -pool_freq, pool_group))
+    mode_first = np.ones(len(mode), dtype=bool)
+    mode_first[1:] = pool_group[mode][1:] != pool_group[mode][:-1]
+    kmer_depth = np.full(ngroups, np.nan)
+    kmer_depth[pool_group[mode][mode_first]] = pool_count[mode][mode_first]
+
+    depth = kmer_depth[groups]
+    KAD = np.log2((read_count + depth) / (depth * (assembly_count + 1)))
+    keep = ~np.isnan(depth) & ~((read_count == 1) & (assembly_count == 0))
+    return groups[keep], kmers[keep], KAD[keep]
+
+
+def KAD_bulk(args, shard):
+    """
+    KAD of a list of contigs with their sequences and reads, counting the k-mers of the
+    contigs and of their reads once for all of them
+    """
+    contigs = []
+    contig_seqs = []
+    read_seqs = []
+    read_contig = []
+    for contig, contig_seq, reads in shard:
+        reads = list(reads)
+        read_contig.extend([len(contigs)] * len(reads))
+        contigs.append(contig)
+        contig_seqs.append(contig_seq)
+        read_seqs.extend(reads)
+    assembly = kmer_group_count(contig_seqs, range(len(contigs)))
+    read = kmer_group_count(read_seqs, read_contig)
+    groups, kmers, KAD_value = kmer_group_KAD(assembly, read)
+    bounds = np.searchsorted(groups, np.arange(len(contigs) + 1))
+    for i, contig in enumerate(contigs):
+        if bounds[i] == bounds[i + 1]:
+            continue
+        savez_atomic(KAD_file(args, contig),
+                     kmer=kmers[bounds[i]:bounds[i + 1]], KAD=KAD_value[bounds[i]:bounds[i + 1]])
+
+
+def jellyfish_count(args, seqs, database):
+    """
+    count the 25-mers of sequences piped to jellyfish count and read them back from the
+    jellyfish dump output stream; the database is removed once it has been read, and
+    CalledProcessError is raised if either jellyfish command fails
+    """
+    count_command = [args.jellyfish, "count", "-m", "25", "-o", database, "-s", "100M", "-t", "8", "/dev/stdin"]
+    count = subprocess.Popen(count_command, stdin=subprocess.PIPE)
+    try:
+        for i, seq in enumerate(seqs):
+            count.stdin.write(">{}\n{}\n".format(i, seq).encode())
+        count.stdin.close()
+    except BrokenPipeError:
+        # jellyfish exited early; its return code is checked below
+        pass
+    try:
+        if count.wait() != 0:
+            raise subprocess.CalledProcessError(count.returncode, count_command)
+        dump_command = [args.jellyfish, "dump", "-c", "-t", database]
+        dump = subprocess.Popen(dump_command, stdout=subprocess.PIPE)
+        kmers, counts = kmer_dump_read(dump.stdout)
+        if dump.wait() != 0:
+            raise subprocess.CalledProcessError(dump.returncode, dump_command)
+    finally:
+        if os.path.exists(database):
+            os.remove(database)
+    return kmers, counts
+
+
+def KAD(args, contig, contig_seq, read_seqs):
+    if os.path.exists(KAD_file(args, contig)):
+        return 0
+    if args.kmer_counter == "jellyfish":
+        database = os.path.join(args.output, "temp/KAD/temp", "{}.jf".format(str(contig)))
+        assembly_kmer, assembly_count = jellyfish_count(args, [contig_seq], database)
+        read_kmer, read_count = jellyfish_count(args, read_seqs, database)
+    else:
+        assembly_kmer, assembly_count = kmer_count([contig_seq])
+        read_kmer, read_count = kmer_count(read_seqs)
+    if len(read_kmer) == 0:
         # zero reads mapped to contig
         return 0
-    shared_kmer = set(assembly_kmer.loc[assembly_kmer[1] == 1, 0]).intersection(read_kmer.index)
+    kmer_result = kmer_KAD(assembly_kmer, assembly_count, read_kmer, read_count)
+    if kmer_result is None:
+        return 0
+    kmers, KAD_value = kmer_result
+    savez_atomic(KAD_file(args, contig), kmer=kmers, KAD=KAD_value)
 
-    if len(shared_kmer) == 0:
-        kmer_depth = pd.value_counts(read_kmer.loc[read_kmer[1] > 5, 1]).index[0]
-    else:
-        kmer_depth = pd.value_counts(read_kmer.loc[shared_kmer, ][1]).index[0]
-
-    assembly_kmer.columns = ['k-mer', 'assembly_count']
-    read_kmer.columns = ['k-mer', 'read_count']
-    assembly_kmer.index = range(assembly_kmer.shape[0])
-    read_kmer.index = range(read_kmer.shape[0])
-    kmer_result = pd.merge(assembly_kmer, read_kmer, how='outer')
-    kmer_result = kmer_result.fillna(0)
-    kmer_result['KAD'] = np.log2((kmer_result['read_count'] + kmer_depth)
-                                 / (kmer_depth * (kmer_result['assembly_count'] + 1)))
-    kmer_result.loc[(kmer_result['read_count'] == 1) *
-                    (kmer_result['assembly_count'] == 0), 'KAD'] = np.nan
-    kmer_result = kmer_result.loc[kmer_result['KAD'] == kmer_result['KAD'], ]
-    kmer_result.loc[:, ['k-mer', 'KAD']].to_csv(
-        os.path.join(args.output, "temp/KAD/KAD_data/", "{}.KAD".format(str(contig))), sep="\t")
-
-
-def fragment_coverage_cal(reads, mu, dev, length):
-    """
-    calculate fragment coverage per contig
-    """
-    frag_coverage = np.array([0] * length)
-    for read in reads:
-        if read.rnext == read.tid and read.is_proper_pair:
-            size = abs(read.isize)
-            if (mu - 3 * dev <= size <= mu + 3 * dev):
-                if read.next_reference_start < read.reference_start:
-                    start = min(read.next_reference_start,
-                                read.reference_start,
-                                read.reference_end)
-                    end = start + size
-                    frag_coverage[start:end] += 1
-    return frag_coverage
-
-
-def window_read_cal(reads, mu, dev):
-    read_dict = {"start_pos": [], "read_count": [], "proper_read_count": [], "inversion_read_count": [], "clipped_read_count": [],
-                 "supplementary_read_count": [], "discordant_size_count": [], "discordant_loc_count": []}
-    read_temp = {"num_read": 0, "num_proper": 0, "num_inversion": 0, "num_clipped": 0, "num_supplementary": 0, "num_discordant_size": 0,
-                 "num_discordant_loc": 0}
-    pos = 0
-    for read in reads:
-        new_pos = math.floor((read.reference_start - 300) / 100) * 100 + 300
-        if read.reference_start < 300:
-            continue
-        if pos == 0:
-            pos = new_pos
-        elif new_pos != pos:
-            read_dict["start_pos"].append(pos)
-            read_dict["read_count"].append(read_temp["num_read"])
-            read_dict["proper_read_count"].append(read_temp["num_proper"])
-            read_dict["inversion_read_count"].append(
-                read_temp["num_inversion"])
-            read_dict["clipped_read_count"].append(read_temp["num_clipped"])
-            read_dict["supplementary_read_count"].append(
-                read_temp["num_supplementary"])
-            read_dict["discordant_size_count"].append(
-                read_temp["num_discordant_size"])
-            read_dict["discordant_loc_count"].append(
-                read_temp["num_discordant_loc"])
-            read_temp = {"num_read": 0,
-                         "num_proper": 0,
-                         "num_inversion": 0,
-                         "num_clipped": 0,
-                         "num_supplementary": 0,
-                         "num_discordant_size": 0,
-                         "num_discordant_loc": 0}
-            pos = new_pos
-        read_temp["num_read"] += 1
-        if read.is_paired:
-            if read.rnext == read.tid:
-                if read.is_proper_pair:
-                    read_temp["num_proper"] += 1
-                if (read.is_reverse + read.mate_is_reverse) != 1:
-                    read_temp["num_inversion"] += 1
-                if not mu - 3 * dev <= abs(read.isize) <= mu + 3 * dev:
-                    read_temp["num_discordant_size"] += 1
-            else:
-                read_temp["num_discordant_loc"] += 1
-        if read.get_cigar_stats()[0][4] > 20:
-            read_temp["num_clipped"] += 1
-        if (read.is_supplementary and read.get_cigar_stats()[0][5] > 20):
-            read_temp["num_supplementary"] += 1
-    return read_dict
+
+def KAD_sketch(args, contig, contig_seq, read_seqs):
+    """
+    approximate KAD of the contig k-mers, with read k-mer counts estimated from a count-min
+    sketch of args.sketch_depth x args.sketch_width counters; returns the bound on the
+    overestimate of any read count, which holds with probability 1 - exp(-args.sketch_depth)
+    """
+    assembly_kmer, assembly_count = kmer_count([contig_seq])
+    table, total = kmer_sketch(read_seqs, args.sketch_width, args.sketch_depth)
+    if total == 0:
+        # zero reads mapped to contig
+        return None
+    read_count = sketch_query(table, assembly_kmer)
+    kmer_result = kmer_KAD(assembly_kmer, assembly_count,
+                           assembly_kmer[read_count > 0], read_count[read_count > 0])
+    if kmer_result is None:
+        return None
+    kmers, KAD_value = kmer_result
+    savez_atomic(KAD_file(args, contig), kmer=kmers, KAD=KAD_value)
+    return math.e / args.sketch_width * total
+
+
+def fragment_coverage_add(read, frag_events, mu, dev):
+    """
+    record the fragment spanned by a read pair as start/end coverage events
+    """
+    if read.rnext == read.tid and read.is_proper_pair:
+        size = abs(read.isize)
+        if (mu - 3 * dev <= size <= mu + 3 * dev):
+            if read.next_reference_start < read.reference_start:
+                start = min(read.next_reference_start,
+                            read.reference_start,
+                            read.reference_end)
+                frag_events["start"].append(start)
+                frag_events["end"].append(start + size)
+
+
+def read_temp_init():
+    return {"num_read": 0,
+            "num_proper": 0,
+            "num_inversion": 0,
+            "num_clipped": 0,
+            "num_supplementary": 0,
+            "num_discordant_size": 0,
+            "num_discordant_loc": 0}
+
+
+def read_class_count(read, cigar, read_temp, mu, dev):
+    """
+    count a read into the read classes of its window
+    """
+    read_temp["num_read"] += 1
+    if read.is_paired:
+        if read.rnext == read.tid:
+            if read.is_proper_pair:
+                read_temp["num_proper"] += 1
+            if (read.is_reverse + read.mate_is_reverse) != 1:
+                read_temp["num_inversion"] += 1
+            if not mu - 3 * dev <= abs(read.isize) <= mu + 3 * dev:
+                read_temp["num_discordant_size"] += 1
+        else:
+            read_temp["num_discordant_loc"] += 1
+    if cigar[2] > 20:
+        read_temp["num_clipped"] += 1
+    if (read.is_supplementary and cigar[3] > 20):
+        read_temp["num_supplementary"] += 1
+
+
+def window_read_add(read_dict, read_temp, pos):
+    read_dict["start_pos"].append(pos)
+    read_dict["read_count"].append(read_temp["num_read"])
+    read_dict["proper_read_count"].append(read_temp["num_proper"])
+    read_dict["inversion_read_count"].append(read_temp["num_inversion"])
+    read_dict["clipped_read_count"].append(read_temp["num_clipped"])
+    read_dict["supplementary_read_count"].append(
+        read_temp["num_supplementary"])
+    read_dict["discordant_size_count"].append(
+        read_temp["num_discordant_size"])
+    read_dict["discordant_loc_count"].append(
+        read_temp["num_discordant_loc"])
 
 
 def window_frag_cal(coverage):
     """
     Using sliding window approach to smooth out features
     """
-    coverage = np.array(coverage)
-    cov = {"pos": [], "coverage": [], "deviation": []}
-    for i in range(300, len(coverage), 100):
-        start = i
-        end = i + 100
-        cov["coverage"].append(np.mean(coverage[start:end]))
-        cov["deviation"].append(
-            np.sqrt(np.var(coverage[start:end])) / np.mean(coverage[start:end]))
-        cov["pos"].append(start)
-        if len(coverage) - end <= 300:
-            break
+    starts = window_starts(len(coverage))
+    mean_cov = window_mean(coverage, starts)
+    cov = {"pos": list(starts),
+           "coverage": mean_cov,
+           "deviation": np.sqrt(window_var(coverage, starts)) / mean_cov}
     return cov
 
 
@@ -282,66 +508,480 @@ def contig_pool(samfile):
 
 
 def pileup_window_cal(pileup_dict):
-    window_dict = {"contig": [], "start_pos": [], "correct_portion": [], "ambiguous_portion": [], "disagree_portion": [],
-                   "deletion_portion": [], "insert_portion": [], "coverage": [], "deviation": []}
-    for i in range(300, len(pileup_dict['correct']), 100):
-        start = i
-        end = i + 100
-        total = np.sum(pileup_dict['depth'][start:end])
-        window_dict["contig"].append(pileup_dict["contig"][0])
-        window_dict["start_pos"].append(start)
-        window_dict["correct_portion"].append(
-            np.sum(pileup_dict['correct'][start:end]) / total)
-        window_dict["ambiguous_portion"].append(
-            np.sum(pileup_dict["ambiguous"][start:end]) / total)
-        window_dict["insert_portion"].append(
-            np.sum(pileup_dict['insert'][start:end]) / total)
-        window_dict["deletion_portion"].append(
-            np.sum(pileup_dict['deletion'][start:end]) / total)
-        window_dict["disagree_portion"].append(
-            np.sum(pileup_dict['disagree'][start:end]) / total)
-        window_dict["coverage"].append(
-            np.mean(pileup_dict["depth"][start:end]))
-        window_dict["deviation"].append(np.sqrt(np.var(
-            pileup_dict["depth"][start:end])) / np.mean(pileup_dict["depth"][start:end]))
-        if len(pileup_dict['correct']) - (i + 100) <= 300:
-            break
+    starts = window_starts(len(pileup_dict['correct']))
+    total = window_sum(pileup_dict['depth'], starts)
+    mean_depth = window_mean(pileup_dict["depth"], starts)
+    window_dict = {"contig": [pileup_dict["contig"][0]] * len(starts),
+                   "start_pos": list(starts),
+                   "correct_portion": window_sum(pileup_dict['correct'], starts) / total,
+                   "ambiguous_portion": window_sum(pileup_dict["ambiguous"], starts) / total,
+                   "disagree_portion": window_sum(pileup_dict['disagree'], starts) / total,
+                   "deletion_portion": window_sum(pileup_dict['deletion'], starts) / total,
+                   "insert_portion": window_sum(pileup_dict['insert'], starts) / total,
+                   "coverage": mean_depth,
+                   "deviation": np.sqrt(window_var(pileup_dict["depth"], starts)) / mean_depth}
     return window_dict
 
 
-def read_breakpoint_per_contig(samfile, ref, lens):
-    reads = samfile.fetch(contig=ref)
-    break_count = {"breakcount": np.array([0] * lens),
-                   "readcount": np.array( [0] * lens)}
-    for read in reads:
-        ref_end = read.reference_end
-        ref_start = read.reference_start
-        read_start = read.query_alignment_start
-        read_end = read.query_alignment_end
-        break_count["readcount"][ref_start:ref_end] += 1
-
-        if read.is_supplementary:
-            if re.match('^([0-9]+H)', read.cigarstring):
-                break_count["breakcount"][read.get_blocks()[0][0]] += 1
-            else:
-                if len(read.get_blocks()) == 1:
-                    break_count["breakcount"][read.get_blocks()[0][1] - 1] += 1
-                else:
-                    break_count["breakcount"][read.get_blocks()[-1][1] - 1] += 1
-
-        if read.get_cigar_stats()[0][4] > 0:
-            if re.match('^([0-9]+S)', read.cigarstring):
-                break_count["breakcount"][read.get_blocks()[0][0]] += 1
-            if (read.cigarstring).endswith('S'):
-                if len(read.get_blocks()) == 1:
-                    break_count["breakcount"][read.get_blocks()[0][1] - 1] += 1
-                else:
-                    break_count["breakcount"][read.get_blocks()[-1][1] - 1] += 1
-    data = pd.DataFrame(break_count)
-    data['position'] = data.index + 1
-    data['contig'] = ref
-    data = data.loc[data['breakcount'] > 0, ]
-    return data
+def pileup_feature_cal(pileup_dict):
+    """
+    window-based pileup features of a contig, with coverage normalized by its mean
+    """
+    window_data = pileup_window_cal(pileup_dict)
+    mean_cov = np.mean(window_data["coverage"])
+    return {"contig": window_data["contig"],
+            "start_pos": window_data["start_pos"],
+            "correct_portion": window_data["correct_portion"],
+            "ambiguous_portion": window_data["ambiguous_portion"],
+            "disagree_portion": window_data["disagree_portion"],
+            "deletion_portion": window_data["deletion_portion"],
+            "insert_portion": window_data["insert_portion"],
+            "normalized_coverage": window_data["coverage"] / mean_cov,
+            "normalized_deviation": window_data["deviation"],
+            "mean_coverage": [mean_cov] * len(window_data["start_pos"])}
+
+
+def window_pileup_init():
+    return {"contig": [], "start_pos": [], "correct_portion": [], "ambiguous_portion": [], "disagree_portion": [],
+            "deletion_portion": [], "insert_portion": [], "normalized_coverage": [], "normalized_deviation": [], "mean_coverage": []}
+
+
+PILEUP_TRACKS = ["correct", "ambiguous", "insert", "deletion", "disagree", "depth"]
+PILEUP_BLOCK = 1 << 14
+PILEUP_BASES = 1 << 20
+
+
+def pileup_events_init(ref_seq, lens):
+    """
+    reads buffered for the pileup of a contig and its per-base tracks; reads are added
+    in reference order and flushed into the tracks block by block
+    """
+    return {"ref_base": np.frombuffer(ref_seq.upper().encode(), dtype=np.uint8),
+            "lens": lens,
+            "reads": [],
+            "bases": 0,
+            "block_end": 0,
+            # reads waiting for an overlapping mate, by name, like the overlap hash of htslib
+            "mates": {},
+            "tracks": {key: np.zeros(lens, dtype=np.int32) for key in PILEUP_TRACKS},
+            "span": np.zeros(lens + 1, dtype=np.int32)}
+
+
+def pileup_add(read, cigar, pileup_events):
+    """
+    record the aligned bases and indels of a read as they would appear in samtools mpileup
+    """
+    # mpileup skips unmapped, secondary, QC-failed and duplicate reads
+    if read.flag & 0x704 or cigar[4] is None:
+        return
+    seq = read.query_sequence
+    if seq is None:
+        return
+    if read.reference_start >= pileup_events["block_end"] or pileup_events["bases"] >= PILEUP_BASES:
+        pileup_flush(pileup_events, read.reference_start)
+        pileup_events["block_end"] = (read.reference_start // PILEUP_BLOCK + 1) * PILEUP_BLOCK
+    qual = read.query_qualities
+    # a missing quality string is stored as 0xff, which passes the base quality filter
+    qual = qual.tobytes() if qual is not None else b'\xff' * len(seq)
+    flag = read.flag
+    record = {"name": read.query_name, "start": read.reference_start, "end": read.reference_end,
+              "seq": seq, "qual": qual, "clip_q": 0,
+              "cigar": read.cigartuples, "gapped": False,
+              "block": [], "insert": [], "deletion": [], "del": [],
+              # proper pairs that may overlap their mate on the contig
+              "mate": bool(flag & 0x2) and not flag & 0x8 and read.next_reference_id == read.reference_id and
+              not (abs(read.template_length) >= 2 * len(seq) and read.next_reference_start >= read.reference_end),
+              "wait": read.next_reference_start >= read.reference_start or
+              bool(flag & 0x1 and read.next_reference_start == -1)}
+
+    clip_q = 0
+    qpos = 0
+    rpos = read.reference_start
+    prev_op = None
+    for op, length in read.cigartuples:
+        if op == 0 or op == 7 or op == 8:
+            record["block"].append((qpos, rpos, length))
+            qpos += length
+            rpos += length
+        elif op == 1:
+            # insertions and deletions are marked on the entry of the preceding reference
+            # position, which for a deleted base has the quality of the next query base
+            if prev_op in (0, 7, 8):
+                record["insert"].append((qpos - 1, rpos - 1))
+            elif prev_op == 2:
+                record["insert"].append((qpos, rpos - 1))
+            qpos += length
+        elif op == 2:
+            if prev_op in (0, 7, 8):
+                record["deletion"].append((qpos - 1, rpos - 1))
+            record["del"].append((rpos, rpos + length, qpos if qpos < len(seq) else -1))
+            record["gapped"] = True
+            rpos += length
+        elif op == 3:
+            record["gapped"] = True
+            rpos += length
+        elif op == 4:
+            clip_q += sum(qual[qpos:qpos + length])
+            qpos += length
+        elif op == 5:
+            clip_q += 13 * length
+        prev_op = op
+    record["clip_q"] = clip_q
+    pileup_events["reads"].append(record)
+    pileup_events["bases"] += len(seq)
+
+
+def cap_mapq_skip(read_id, read_base, ref_base, base_qual, block_read, block_len, clip_q, capq_thres=50):
+    """
+    reads dropped by samtools mpileup -C for excessive mismatches and clipping
+    (the sam_cap_mapq rule, applied to the bases of all reads of a contig at once)
+    """
+    num_reads = len(clip_q)
+    valid = (read_base != ord('N')) & (ref_base != ord('N')) & (base_qual >= 13)
+    mismatch = valid & (read_base != ref_base)
+    aligned_len = np.bincount(read_id[valid], minlength=num_reads) + \
+        np.bincount(block_read, weights=block_len, minlength=num_reads)
+    num_mismatch = np.bincount(read_id[mismatch], minlength=num_reads)
+    mismatch_q = np.bincount(read_id[mismatch], weights=np.minimum(base_qual[mismatch], 33), minlength=num_reads)
+    log_factorial = np.concatenate([[0], np.cumsum(np.log(np.arange(1, num_mismatch.max(initial=0) + 1)))])
+    log_t = num_mismatch * np.log(np.maximum(aligned_len, 1)) - log_factorial[num_mismatch]
+    t = mismatch_q - 4.343 * log_t + np.array(clip_q) / 5.
+    return t > capq_thres
+
+
+def mate_keep_first(name):
+    """
+    whether htslib keeps the quality of the first of two overlapping mates, chosen
+    from the X31 and Wang hashes of the read name
+    """
+    key = 0
+    for i, char in enumerate(name.encode()):
+        key = char if i == 0 else (key * 31 + char) & 0xffffffff
+    key = (key + (~(key << 15) & 0xffffffff)) & 0xffffffff
+    key ^= key >> 10
+    key = (key + (key << 3)) & 0xffffffff
+    key ^= key >> 6
+    key = (key + (~(key << 11) & 0xffffffff)) & 0xffffffff
+    key ^= key >> 16
+    return bool(key & 1)
+
+
+def cigar_ref_set(cigar, pos):
+    """
+    cigar state [op, offset in op, query index, reference offset] at the first aligned
+    base pos or more bases into the reference span of a read, None if there is none
+    """
+    iseq = iref = 0
+    for c, (op, length) in enumerate(cigar):
+        if op in (0, 7, 8):
+            pos -= length
+            if pos < 0:
+                return [c, length + pos, iseq + length + pos, iref + length + pos]
+            iseq += length
+            iref += length
+        elif op in (1, 4):
+            iseq += length
+        elif op in (2, 3):
+            pos = max(pos - length, 0)
+            iref += length
+    return None
+
+
+def cigar_ref_next(cigar, state):
+    """
+    move a cigar state to the next aligned base, False past the last one
+    """
+    c, icig, iseq, iref = state
+    while c < len(cigar):
+        op, length = cigar[c]
+        if op in (0, 7, 8):
+            if icig < length - 1:
+                state[:] = [c, icig + 1, iseq + 1, iref + 1]
+                return True
+        elif op in (2, 3):
+            iref += length
+        elif op in (1, 4):
+            iseq += length
+        c += 1
+        icig = -1
+    return False
+
+
+def mate_gap_tweak(qual, seq, a, b, qa, qb, keep_first):
+    """
+    tweak_overlap_quality of htslib for mates with deletions or skips: walk both cigars
+    over the overlap, and where one mate skips ahead over a deletion scale (0.8) or drop
+    the bases of the other mate until it catches up
+    """
+    a_cigar, b_cigar = a["cigar"], b["cigar"]
+    a_pos, b_pos = a["start"], b["start"]
+    pos = b_pos
+    a_state = cigar_ref_set(a_cigar, pos - a_pos)
+    b_state = cigar_ref_set(b_cigar, 0)
+    if a_state is None or b_state is None:
+        return
+    while True:
+        while a_state[3] < pos - a_pos:
+            if not cigar_ref_next(a_cigar, a_state):
+                return
+        while b_state[3] < pos - b_pos:
+            if not cigar_ref_next(b_cigar, b_state):
+                return
+        a_ref = a_state[3] + a_pos
+        b_ref = b_state[3] + b_pos
+        pos = max(pos, a_ref, b_ref) + 1
+        if a_ref < b_ref and b_state[0] > 0 and b_cigar[b_state[0] - 1][0] == 2:
+            while True:
+                i = qa + a_state[2]
+                qual[i] = int(qual[i] * 0.8) if keep_first else 0
+                if not cigar_ref_next(a_cigar, a_state):
+                    return
+                if a_state[3] + a_pos >= b_ref:
+                    break
+        elif a_ref != b_ref and a_state[0] > 0 and a_cigar[a_state[0] - 1][0] == 2:
+            while True:
+                i = qb + b_state[2]
+                qual[i] = 0 if keep_first else int(qual[i] * 0.8)
+                if not cigar_ref_next(b_cigar, b_state):
+                    return
+                if b_state[3] + b_pos >= a_ref:
+                    break
+        elif a_ref != b_ref:
+            continue
+        i = qa + a_state[2]
+        j = qb + b_state[2]
+        if seq[i] == seq[j]:
+            both = min(int(qual[i]) + int(qual[j]), 200)
+            qual[i], qual[j] = (both, 0) if keep_first else (0, both)
+        elif qual[i] > qual[j]:
+            qual[i], qual[j] = int(0.8 * qual[i]), 0
+        elif qual[i] < qual[j]:
+            qual[i], qual[j] = 0, int(0.8 * qual[j])
+        else:
+            qual[i], qual[j] = (int(0.8 * qual[i]), 0) if keep_first else (0, int(0.8 * qual[j]))
+
+
+def mate_overlap_tweak(qual, seq, read_id, qidx, ridx, pairs, reads, qoffset):
+    """
+    adjust in place the base qualities of overlapping mates as htslib does for samtools
+    mpileup: where both mates have a base at a position, one of them (chosen by read name)
+    gets the summed quality (at most 200) and the other 0 if the bases agree; otherwise
+    the lower quality becomes 0 and the higher one is scaled by 0.8
+    """
+    if not pairs:
+        return
+    num_reads = len(reads)
+    keep = np.zeros(num_reads, dtype=bool)
+    plain = []
+    for first, second in pairs:
+        keep_first = mate_keep_first(reads[first]["name"])
+        if not reads[first]["gapped"] and not reads[second]["gapped"]:
+            plain.append((first, second))
+            keep[first] = keep_first
+            keep[second] = not keep_first
+        else:
+            mate_gap_tweak(qual, seq, reads[first], reads[second], qoffset[first], qoffset[second], keep_first)
+    if not plain:
+        return
+    # without deletions the overlap is every position where both mates have a base
+    first, second = np.array(plain, dtype=np.int64).T
+    pair = np.full(num_reads, -1, dtype=np.int64)
+    pair[first] = np.arange(len(plain))
+    pair[second] = np.arange(len(plain))
+    role = np.zeros(num_reads, dtype=np.int64)
+    role[second] = 1
+    sel = np.flatnonzero(pair[read_id] >= 0)
+    order = sel[np.lexsort((role[read_id[sel]], ridx[sel], pair[read_id[sel]]))]
+    pair_pos = pair[read_id[order]]
+    ref_pos = ridx[order]
+    both = np.flatnonzero((pair_pos[1:] == pair_pos[:-1]) & (ref_pos[1:] == ref_pos[:-1]))
+    qa = qidx[order[both]]
+    qb = qidx[order[both + 1]]
+    va = qual[qa].astype(np.int64)
+    vb = qual[qb].astype(np.int64)
+    same = seq[qa] == seq[qb]
+    keep_a = np.where(same | (va == vb), keep[read_id[order[both]]], va > vb)
+    kept = np.where(same, np.minimum(va + vb, 200), (0.8 * np.where(keep_a, va, vb)).astype(np.int64))
+    qual[qa] = np.where(keep_a, kept, 0)
+    qual[qb] = np.where(keep_a, 0, kept)
+
+
+def pileup_flush(pileup_events, next_pos, min_baseq=13):
+    """
+    add the buffered reads to the pileup tracks of a contig, given that reads not added
+    yet start at next_pos or later; reads waiting for an overlapping mate stay buffered
+    """
+    reads = pileup_events["reads"]
+    if not reads:
+        return
+    ref_base = pileup_events["ref_base"]
+    lens = pileup_events["lens"]
+    num_reads = len(reads)
+    seq = np.frombuffer(''.join(read["seq"] for read in reads).upper().encode(), dtype=np.uint8)
+    qual = np.frombuffer(b''.join(read["qual"] for read in reads), dtype=np.uint8).copy()
+    qoffset = np.cumsum([0] + [len(read["seq"]) for read in reads])
+
+    def events(kind, width):
+        rows = [(i,) + event for i, read in enumerate(reads) for event in read[kind]]
+        return np.array(rows, dtype=np.int64).reshape(-1, width + 1).T
+
+    block_read, block_q, block_r, block_len = events("block", 3)
+    offset = np.repeat(np.cumsum(block_len) - block_len, block_len)
+    base = np.arange(offset.shape[0]) - offset
+    read_id = np.repeat(block_read, block_len)
+    qidx = np.repeat(qoffset[block_read] + block_q, block_len) + base
+    ridx = np.repeat(block_r, block_len) + base
+    inside = ridx < lens
+    clip_q = [read["clip_q"] for read in reads]
+    # the -C rule is applied to the original qualities, before mates are compared
+    skip = cap_mapq_skip(read_id[inside], seq[qidx[inside]], ref_base[ridx[inside]], qual[qidx[inside]],
+                         block_read, block_len, clip_q)
+
+    # reads are paired in the order samtools adds them to the pileup
+    index = {id(read): i for i, read in enumerate(reads)}
+    mates = pileup_events["mates"]
+    pairs = []
+    for i in range(pileup_events.get("waiting", 0), num_reads):
+        read = reads[i]
+        if skip[i] or not read["mate"]:
+            continue
+        mate = mates.pop(read["name"], None)
+        if mate is not None and mate["end"] > read["start"]:
+            pairs.append((index[id(mate)], i))
+        elif read["wait"]:
+            mates[read["name"]] = read
+    waiting = set()
+    for name, mate in list(mates.items()):
+        if mate["end"] > next_pos:
+            waiting.add(index[id(mate)])
+        else:
+            del mates[name]
+    mate_overlap_tweak(qual, seq, read_id, qidx, ridx, pairs, reads, qoffset)
+    done = np.ones(num_reads, dtype=bool)
+    done[list(waiting)] = False
+    pileup_events["reads"] = [reads[i] for i in sorted(waiting)]
+    pileup_events["waiting"] = len(waiting)
+    pileup_events["bases"] = sum(len(read["seq"]) for read in pileup_events["reads"])
+    counted = done & ~skip
+    if not counted.any():
+        return
+
+    span_start = np.array([read["start"] for read in reads], dtype=np.int64)[counted]
+    span_end = np.minimum(np.array([read["end"] for read in reads], dtype=np.int64)[counted], lens)
+    lo = int(span_start.min())
+    hi = max(int(span_end.max()), lo)
+    tracks = pileup_events["tracks"]
+
+    def track_add(name, positions):
+        positions = positions[(positions >= lo) & (positions < hi)]
+        tracks[name][lo:hi] += np.bincount(positions - lo, minlength=hi - lo).astype(np.int32)
+
+    keep = inside & counted[read_id]
+    keep[keep] = qual[qidx[keep]] >= min_baseq
+    base_r = ridx[keep]
+    read_base = seq[qidx[keep]]
+    match = read_base == ref_base[base_r]
+    track_add("correct", base_r[match])
+    track_add("disagree", base_r[~match & np.isin(read_base, np.frombuffer(b'ACGT', dtype=np.uint8))])
+    track_add("depth", base_r)
+    for kind in ["insert", "deletion"]:
+        marker_read, marker_q, marker_r = events(kind, 2)
+        marker_q = qoffset[marker_read] + marker_q
+        marker_keep = counted[marker_read] & (qual[marker_q] >= min_baseq)
+        track_add(kind, marker_r[marker_keep])
+    # a deleted base is filtered on the quality of the query base following the deletion
+    del_read, del_start, del_end, del_q = events("del", 3)
+    del_keep = counted[del_read] & (del_q >= 0)
+    del_keep[del_keep] = qual[qoffset[del_read[del_keep]] + del_q[del_keep]] >= min_baseq
+    deleted = coverage_track(del_start[del_keep] - lo, del_end[del_keep] - lo, hi - lo).astype(np.int32)
+    tracks["ambiguous"][lo:hi] += deleted
+    tracks["depth"][lo:hi] += deleted
+    np.add.at(pileup_events["span"], span_start, 1)
+    np.add.at(pileup_events["span"], span_end, -1)
+
+
+def pileup_track_cal(pileup_events, ref):
+    """
+    per-base correct, ambiguous, insert, deletion, disagree and depth tracks of a contig,
+    restricted to the covered non-N positions reported by
+    samtools mpileup -B -C 50 -A | awk '$3 != "N"' (base alignment qualities are not computed)
+    """
+    pileup_flush(pileup_events, math.inf)
+    lens = pileup_events["lens"]
+    tracks = pileup_events["tracks"]
+    covered = np.cumsum(pileup_events["span"][:lens]) > 0
+    covered &= pileup_events["ref_base"][:lens] != ord('N')
+    # mpileup prints '*' at a covered position without bases passing the quality
+    # filter, which the pileup file parser counts as ambiguous
+    tracks["ambiguous"] += covered & (tracks["depth"] == 0)
+    pileup_dict = {key: value[covered] for key, value in tracks.items()}
+    pileup_dict["contig"] = [ref]
+    return pileup_dict
+
+
+def cigar_parse(read):
+    """
+    first and last CIGAR operations, soft/hard clipped lengths and the reference
+    span of the aligned blocks of a read, in one pass over its cigartuples
+    """
+    soft_clip = 0
+    hard_clip = 0
+    block_start = None
+    block_end = None
+    pos = read.reference_start
+    cigar = read.cigartuples
+    if not cigar:
+        return None, None, 0, 0, None, None
+    for op, length in cigar:
+        if op == 0 or op == 7 or op == 8:
+            if block_start is None:
+                block_start = pos
+            pos += length
+            block_end = pos
+        elif op == 2 or op == 3:
+            pos += length
+        elif op == 4:
+            soft_clip += length
+        elif op == 5:
+            hard_clip += length
+    return cigar[0][0], cigar[-1][0], soft_clip, hard_clip, block_start, block_end
+
+
+def read_breakpoint_add(read, cigar, break_count):
+    """
+    record the read depth and the clipped ends of a read as breakpoint events
+    """
+    first_op, last_op, soft_clip, hard_clip, block_start, block_end = cigar
+    break_count["read_start"].append(read.reference_start)
+    break_count["read_end"].append(read.reference_end)
+    if block_start is None:
+        return
+
+    if read.is_supplementary:
+        if first_op == 5:
+            break_count["position"].append(block_start)
+        else:
+            break_count["position"].append(block_end - 1)
+
+    if soft_clip > 0:
+        if first_op == 4:
+            break_count["position"].append(block_start)
+        if last_op == 4:
+            break_count["position"].append(block_end - 1)
+
+
+def read_breakpoint_data(break_count, lens):
+    """
+    sparse positions of a contig with at least one read breakpoint,
+    with their breakpoint counts and read depth
+    """
+    position, breakcount = np.unique(np.array(break_count["position"], dtype=np.int64), return_counts=True)
+    # unmapped mates placed on the contig have no reference end
+    read_end = [lens if end is None else end for end in break_count["read_end"]]
+    readcount = coverage_track(break_count["read_start"], read_end, lens)
+    return {"position": position + 1,
+            "read_breakpoint_count": breakcount,
+            "read_count": readcount[position]}
 
 
 def window_break_cal(data):
@@ -349,247 +989,477 @@ def window_break_cal(data):
     data = data.loc[data['start_pos'] >= 300, ]
     data['read_breakpoint_ratio'] = data['read_breakpoint_count'] / \
         data['read_count']
-    data['index'] = data['contig'] + '_' + \
-        [str(int(x)) for x in data['start_pos']]
-    grouped = data.groupby(['index'])
-    read_break_ratio = pd.DataFrame(grouped['read_breakpoint_ratio'].max())
-    read_break_ratio['contig'] = ['_'.join(x.split("_")[:-1]) for x in read_break_ratio.index]
-    read_break_ratio['start_pos'] = [int(x.split("_")[-1]) for x in read_break_ratio.index]
-    read_break_ratio.index = range(read_break_ratio.shape[0])
+    # windows in the order of the per-base table, which is in reference order
+    read_break_ratio = data.groupby(['contig', 'start_pos'], sort=False)['read_breakpoint_ratio'].max().reset_index()
+    read_break_ratio = read_break_ratio.loc[:, ['read_breakpoint_ratio', 'contig', 'start_pos']]
     return read_break_ratio
 
 
-def read_breakpoint_cal(args):
-    if os.path.exists(os.path.join(args.output,
-                                   "temp/read_breakpoint/read_breakpoint_per_window.txt")):
-        return 0
+# classes of the symbols of the read base column of samtools mpileup
+PILEUP_CORRECT, PILEUP_AMBIGUOUS, PILEUP_DISAGREE, PILEUP_INSERT, PILEUP_DELETION, PILEUP_START = range(1, 7)
+PILEUP_CLASS = np.zeros(256, dtype=np.uint8)
+for symbols, symbol_class in [(b'.,', PILEUP_CORRECT), (b'*', PILEUP_AMBIGUOUS), (b'ACGTacgt', PILEUP_DISAGREE),
+                              (b'+', PILEUP_INSERT), (b'-', PILEUP_DELETION), (b'^', PILEUP_START)]:
+    PILEUP_CLASS[np.frombuffer(symbols, dtype=np.uint8)] = symbol_class
 
-    if os.path.exists(os.path.join(args.output,
-                                   "temp/read_breakpoint/read_breakpoint_per_base.txt")):
-        read_breakpoint_data = pd.read_csv(os.path.join(args.output,
-                                                        "temp/read_breakpoint/read_breakpoint_per_base.txt"), sep="\t", index_col=0)
-        window_read_breakpoint_data = window_break_cal(read_breakpoint_data)
-        window_read_breakpoint_data.to_csv(os.path.join(args.output,
-                                                        "temp/read_breakpoint/read_breakpoint_per_window.txt"),sep="\t")
-        return 0
 
-    samfile = pysam.AlignmentFile(args.bamfile, "rb")
-    references = samfile.references
-    lengths = samfile.lengths
-    read_breakpoint_pool = {"contig": [],
-                            "position": [],
-                            "read_breakpoint_count": [],
-                            "read_count": []}
+def pileup_block_parse(block):
+    """
+    per-line pileup counts of a byte block of complete samtools mpileup lines,
+    counted in bulk on bytes; returns the contig segments of the block and the counts
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    size = data.shape[0]
+    line_end = np.flatnonzero(data == ord('\n'))
+    line_start = np.concatenate([[0], line_end[:-1] + 1]).astype(np.int64)
+    num_lines = line_start.shape[0]
+    tab = np.flatnonzero(data == ord('\t'))
+    first_tab = np.searchsorted(tab, line_start)
+    depth_start = tab[first_tab + 2] + 1
+    bases_start = tab[first_tab + 3] + 1
+    bases_end = tab[first_tab + 4]
 
-    for ref, lens in zip(references, lengths):
-        if lens < args.min_length:
-            continue
-        contig_break_data = read_breakpoint_per_contig(samfile, ref, lens)
-        if contig_break_data.shape[0] > 0:
-            read_breakpoint_pool["read_breakpoint_count"].extend(
-                list(contig_break_data['breakcount']))
-            read_breakpoint_pool["read_count"].extend(
-                list(contig_break_data['readcount']))
-            read_breakpoint_pool["contig"].extend(
-                [ref] * contig_break_data.shape[0])
-            read_breakpoint_pool["position"].extend(
-                list(contig_break_data['position']))
-    read_breakpoint_data = pd.DataFrame(read_breakpoint_pool)
-    read_breakpoint_data.to_csv(os.path.join(args.output,
-                                             "temp/read_breakpoint/read_breakpoint_per_base.txt"), sep="\t")
-    window_read_breakpoint_data = window_break_cal(read_breakpoint_data)
-    window_read_breakpoint_data.to_csv(os.path.join(args.output,
-                                                    "temp/read_breakpoint/read_breakpoint_per_window.txt"), sep="\t")
-
-
-def pileupfile_parse(args):
-    """
-    process pileup file
-    """
-    if os.path.exists(os.path.join(args.output,
-                                   "temp/pileup/pileup_feature.txt")):
+    depth_width = bases_start - 1 - depth_start
+    depth = np.zeros(num_lines, dtype=np.int64)
+    for k in range(depth_width.max(initial=0)):
+        active = k < depth_width
+        digit = data[np.minimum(depth_start + k, size - 1)].astype(np.int64) - ord('0')
+        depth = np.where(active, depth * 10 + digit, depth)
+
+    symbol = PILEUP_CLASS[data]
+    # read starts and indels are rare, so they are located in the base column one by one
+    marker = np.flatnonzero(symbol >= PILEUP_INSERT)
+    marker_line = np.searchsorted(line_start, marker, side='right') - 1
+    in_bases = (marker >= bases_start[marker_line]) & (marker < bases_end[marker_line])
+    marker = marker[in_bases]
+    marker_line = marker_line[in_bases]
+    marker_class = symbol[marker]
+    # the character after '^' is the mapping quality of a read start
+    mapq = marker[marker_class == PILEUP_START] + 1
+    indel = (marker_class != PILEUP_START) & ~np.isin(marker, mapq)
+    indel_line = marker_line[indel]
+    indel_class = marker_class[indel]
+    indel = marker[indel]
+    # '+N'/'-N' is followed by N inserted/deleted bases that are not pileup symbols
+    indel_len = np.zeros(indel.shape[0], dtype=np.int64)
+    num_digits = np.zeros(indel.shape[0], dtype=np.int64)
+    active = np.ones(indel.shape[0], dtype=bool)
+    while active.any():
+        digit = data[np.minimum(indel + 1 + num_digits, size - 1)].astype(np.int64) - ord('0')
+        active &= (digit >= 0) & (digit <= 9)
+        indel_len = np.where(active, indel_len * 10 + digit, indel_len)
+        num_digits += active
+
+    # a byte is a pileup symbol where the base column is entered and no skipped span is
+    # open, found with one cumulative sum over the entry and exit events of both
+    events = np.zeros(size + 1, dtype=np.int8)
+    events[bases_start] += 1
+    events[bases_end] -= 1
+    events[mapq] -= 1
+    events[mapq + 1] += 1
+    events[indel + 1] -= 1
+    events[indel + 1 + num_digits + indel_len] += 1
+    valid = np.cumsum(events[:size], dtype=np.int8) == 1
+    symbol = symbol * valid
+
+    def line_count(symbol_class):
+        return np.add.reduceat((symbol == symbol_class).view(np.uint8), line_start, dtype=np.int32).astype(np.int64)
+
+    counts = {"correct": line_count(PILEUP_CORRECT),
+              "ambiguous": line_count(PILEUP_AMBIGUOUS),
+              "insert": np.bincount(indel_line[indel_class == PILEUP_INSERT], minlength=num_lines),
+              "deletion": np.bincount(indel_line[indel_class == PILEUP_DELETION], minlength=num_lines),
+              "disagree": line_count(PILEUP_DISAGREE),
+              "depth": depth}
+
+    # lines of a contig are contiguous, so each contig boundary is found by bisection
+    segments = []
+    i = 0
+    while i < line_start.shape[0]:
+        name = block[line_start[i]:tab[first_tab[i]]]
+        key = name + b'\t'
+        lo = i
+        hi = line_start.shape[0]
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if block.startswith(key, line_start[mid]):
+                lo = mid
+            else:
+                hi = mid
+        segments.append((name.decode(), i, hi))
+        i = hi
+    return segments, counts
+
+
+def pileup_range_parse(pileup_file, byte_range, contig_len, min_length, done=(), block_size=1 << 25):
+    """
+    window-based pileup features of the contigs not done yet in a byte range of a pileup
+    file, and the contigs they were computed for
+    """
+    start, end = byte_range
+    contigs = []
+    window_pileup_dict = window_pileup_init()
+    prev_contig = None
+    pieces = []
+
+    def contig_flush():
+        if prev_contig is not None and contig_len[prev_contig] >= min_length and prev_contig not in done:
+            pileup_dict = {key: np.concatenate([piece[key] for piece in pieces]) for key in pieces[0]}
+            pileup_dict["contig"] = [prev_contig]
+            feature_extend(window_pileup_dict, pileup_feature_cal(pileup_dict))
+            contigs.append(prev_contig)
+
+    with open(pileup_file, "rb") as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            block = f.read(min(block_size, end - offset))
+            if not block:
+                break
+            if not block.endswith(b'\n'):
+                block += f.readline()
+            offset += len(block)
+            segments, counts = pileup_block_parse(block)
+            for contig, first, last in segments:
+                if contig != prev_contig:
+                    contig_flush()
+                    prev_contig = contig
+                    pieces = []
+                pieces.append({key: value[first:last] for key, value in counts.items()})
+    contig_flush()
+    return contigs, window_pileup_dict
+
+
+def pileup_file_split(pileup_file, parts):
+    """
+    byte offsets splitting a pileup file into up to parts ranges at contig boundaries
+    """
+    size = os.path.getsize(pileup_file)
+    offsets = [0]
+    with open(pileup_file, "rb") as f:
+        for i in range(1, parts):
+            offset = max(size * i // parts, offsets[-1])
+            f.seek(offset)
+            f.readline()
+            line = f.readline()
+            if not line:
+                break
+            key = line.split(b'\t')[0] + b'\t'
+            offset = f.tell()
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    offset = size
+                    break
+                if not chunk.endswith(b'\n'):
+                    chunk += f.readline()
+                last_start = chunk.rfind(b'\n', 0, len(chunk) - 1) + 1
+                if chunk.startswith(key, last_start):
+                    offset += len(chunk)
+                    continue
+                last_line = chunk.rfind(b'\n' + key)
+                if last_line >= 0:
+                    offset += chunk.index(b'\n', last_line + 1) + 1
+                elif chunk.startswith(key):
+                    offset += chunk.index(b'\n') + 1
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    if offsets[-1] < size:
+        offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def pileupfile_parse(args, threads):
+    """
+    process pileup file generated by samtools mpileup, splitting it at contig
+    boundaries over a pool of threads workers; contigs done by an earlier run
+    are read back from the checkpoint store
+    """
+    if args.pileup is None:
+        # pileup features are computed by bam_feature_cal
         return 0
-    if not os.path.exists(args.pileup):
-        if os.path.exists(os.path.join(args.output,
-                                       "temp/pileup/contigs_pipelup.out")):
-            args.pileup = os.path.join(args.output, "temp/pileup/contigs_pipelup.out")
-        else:
-            if not os.path.exists(args.assemblies):
-                if os.path.exists(os.path.join(args.output,
-                                               "temp/contig/filtered_contigs.fa")):
-                    args.assemblies = os.path.join(args.output, "temp/contig/filtered_contigs.fa")
-                else:
-                    sys.stderr.write("Error: Can not find assemblies:{}!\n".format(args.assemblies))
-                    sys.exit(1)
-
-            os.makedirs(os.path.join(args.output, "temp/pileup"), exist_ok=True)
-            pileup_command = ' '.join([args.samtools,
-                                       'mpileup -C 50 -A -f',
-                                       args.assemblies,
-                                       args.bamfile,
-                                       " | awk", "'", "$3 !=", "\"N\"", "'", ">",
-                                       os.path.join(args.output, "temp/pileup/contigs_pipelup.out")])
-            args.pileup = os.path.join(args.output, "temp/pileup/contigs_pipelup.out")
-            os.system(pileup_command)
+    manifest = stage_manifest([args.bamfile, args.pileup],
+                              {"min_length": args.min_length, "feature_format": args.feature_format})
+    if stage_cached(args.output, "pileup", manifest,
+                    feature_exists(os.path.join(args.output, "temp/pileup/pileup_feature"), args.feature_format)):
+        return 0
+    stage_start(args.output, "pileup")
+    feature_discard(os.path.join(args.output, "temp/pileup/pileup_feature"))
+    # checkpoint parts keep float64 features when the tables are written as text
+    float32 = args.feature_format != "tsv"
+    checkpoint = stage_checkpoint(args.output, "pileup",
+                                  stage_manifest([args.bamfile, args.pileup], {"float32": float32}))
     samfile = pysam.AlignmentFile(args.bamfile, "rb")
     contig_len = contig_pool(samfile)
 
-    prev_contig = None
-    pileup_dict = {"contig": [], "correct": [], "ambiguous": [], "insert": [],
-                   "deletion": [], "disagree": [], "depth": []}
-    window_pileup_dict = {"contig": [], "start_pos": [], "correct_portion": [], "ambiguous_portion": [], "disagree_portion": [],
-                          "deletion_portion": [], "insert_portion": [], "normalized_coverage": [], "normalized_deviation": [], "mean_coverage": []}
-
-    for line in open(args.pileup, "r"):
-        record = line.strip().split('\t')
-        if contig_len[record[0]] < args.min_length:
-            continue
-        if prev_contig is None:
-            prev_contig = record[0]
-        if record[0] != prev_contig:
-            window_data = pileup_window_cal(pileup_dict)
-            mean_cov = np.mean(window_data["coverage"])
-            window_pileup_dict["contig"].extend(window_data["contig"])
-            window_pileup_dict["start_pos"].extend(window_data["start_pos"])
-            window_pileup_dict["correct_portion"].extend(
-                window_data["correct_portion"])
-            window_pileup_dict["ambiguous_portion"].extend(
-                window_data["ambiguous_portion"])
-            window_pileup_dict["disagree_portion"].extend(
-                window_data["disagree_portion"])
-            window_pileup_dict["deletion_portion"].extend(
-                window_data["deletion_portion"])
-            window_pileup_dict["insert_portion"].extend(
-                window_data["insert_portion"])
-            window_pileup_dict["normalized_coverage"].extend(
-                window_data["coverage"] / mean_cov)
-            window_pileup_dict["normalized_deviation"].extend(
-                window_data["deviation"])
-            window_pileup_dict["mean_coverage"].extend(
-                [mean_cov] * len(window_data["start_pos"]))
-            pileup_dict = {"contig": [],
-                           "correct": [],
-                           "ambiguous": [],
-                           "insert": [],
-                           "deletion": [],
-                           "disagree": [],
-                           "depth": []}
-            prev_contig = record[0]
-        pileup_dict['contig'].append(record[0])
-        match_detail = record[4]
-        pileup_dict['correct'].append(match_detail.count('.') + match_detail.count(','))
-        pileup_dict['ambiguous'].append(match_detail.count('*'))
-        pileup_dict['insert'].append(match_detail.count("+"))
-        pileup_dict['deletion'].append(match_detail.count("-"))
-        pileup_dict['depth'].append(int(record[3]))
-        st = ''.join(re.split(r'[\+|\-][0-9]+[ATCGatcg]+', match_detail))
-        numd = st.count('a') + st.count('A') + st.count('t') + st.count('T') + \
-            st.count('c') + st.count('C') + st.count('g') + st.count('G')
-        pileup_dict['disagree'].append(numd)
+    # every range is checkpointed as soon as it is parsed
+    ranges = pileup_file_split(args.pileup, threads * 8)
+    with multiprocessing.Pool(processes=threads) as pool:
+        for contigs, window_data in pool.imap_unordered(
+                partial(pileup_range_parse, args.pileup, contig_len=contig_len, min_length=args.min_length,
+                        done=set(contig_store_done(checkpoint))), ranges):
+            contig_store_append(checkpoint, contigs, {"pileup": pd.DataFrame(window_data)}, float32)
 
     if not os.path.exists(os.path.join(args.output, "temp/pileup")):
         os.makedirs(os.path.join(args.output, "temp/pileup"), exist_ok=True)
 
-    data = pd.DataFrame(window_pileup_dict)
-    data.to_csv(os.path.join(args.output, "temp/pileup/pileup_feature.txt"), sep="\t")
+    data = contig_store_read(checkpoint, "pileup",
+                             [ref for ref, lens in contig_len.items() if lens >= args.min_length],
+                             list(window_pileup_init()))
+    feature_write(data, os.path.join(args.output, "temp/pileup/pileup_feature"), args.feature_format)
+    stage_done(args.output, "pileup", manifest)
     return data
 
 
-def read_cal(args, mu, dev):
-    if os.path.exists(os.path.join(args.output,
-                                   "temp/read_feature/read_feature.txt")):
-        return 0
-    samfile = pysam.AlignmentFile(args.bamfile, "rb")
-    references = samfile.references
-    lengths = samfile.lengths
-    read_dicts = {"contig": [], "start_pos": [], "read_count": [], "proper_read_count": [], "inversion_read_count": [],
-                  "clipped_read_count": [], "supplementary_read_count": [], "discordant_size_count": [], "discordant_loc_count": [], "length": []}
-    for ref, lens in zip(references, lengths):
-        if lens < args.min_length:
+def contig_feature_cal(samfile, ref, lens, mu, dev, fastafile=None):
+    """
+    calculate read, fragment coverage and read breakpoint features of a contig
+    in a single pass over its alignments; with the assemblies given, pileup
+    features are computed from the same pass
+    """
+    read_dict = {"start_pos": [], "read_count": [], "proper_read_count": [], "inversion_read_count": [], "clipped_read_count": [],
+                 "supplementary_read_count": [], "discordant_size_count": [], "discordant_loc_count": []}
+    read_temp = read_temp_init()
+    frag_events = {"start": [], "end": []}
+    break_count = {"position": [],
+                   "read_start": [],
+                   "read_end": []}
+    if fastafile is not None:
+        pileup_events = pileup_events_init(fastafile.fetch(ref), lens)
+    pos = 0
+    for read in samfile.fetch(ref):
+        cigar = cigar_parse(read)
+        fragment_coverage_add(read, frag_events, mu, dev)
+        read_breakpoint_add(read, cigar, break_count)
+        if fastafile is not None:
+            pileup_add(read, cigar, pileup_events)
+        if read.reference_start < 300:
             continue
-        contig_reads = samfile.fetch(ref)
-        read_dict = window_read_cal(contig_reads, mu, dev)
-        read_dicts["start_pos"].extend(read_dict["start_pos"])
-        read_dicts["contig"].extend([ref] * len(read_dict["start_pos"]))
-        read_dicts["read_count"].extend(read_dict["read_count"])
-        read_dicts["proper_read_count"].extend(read_dict["proper_read_count"])
-        read_dicts["inversion_read_count"].extend(
-            read_dict["inversion_read_count"])
-        read_dicts["clipped_read_count"].extend(
-            read_dict["clipped_read_count"])
-        read_dicts["supplementary_read_count"].extend(
-            read_dict["supplementary_read_count"])
-        read_dicts["discordant_size_count"].extend(
-            read_dict["discordant_size_count"])
-        read_dicts["discordant_loc_count"].extend(
-            read_dict["discordant_loc_count"])
-        read_dicts["length"].extend([lens] * len(read_dict["start_pos"]))
-    data = pd.DataFrame(read_dicts)
-    data.to_csv(os.path.join(args.output,
-                             "temp/read_feature/read_feature.txt"), sep="\t")
-
-
-def fragment_cal(args, mu, dev):
-    if os.path.exists(os.path.join(args.output,
-                                   "temp/coverage/fragment_coverage.txt")):
+        new_pos = math.floor((read.reference_start - 300) / 100) * 100 + 300
+        if pos == 0:
+            pos = new_pos
+        elif new_pos != pos:
+            window_read_add(read_dict, read_temp, pos)
+            read_temp = read_temp_init()
+            pos = new_pos
+        read_class_count(read, cigar, read_temp, mu, dev)
+    read_dict["contig"] = [ref] * len(read_dict["start_pos"])
+    read_dict["length"] = [lens] * len(read_dict["start_pos"])
+
+    fragcov = window_frag_cal(coverage_track(frag_events["start"], frag_events["end"], lens))
+    frag_dict = {"contig": [ref] * len(fragcov['pos']),
+                 "start_pos": fragcov["pos"],
+                 "normalized_fragment_coverage": list(fragcov["coverage"] / np.mean(fragcov["coverage"])),
+                 "normalized_fragment_deviation": fragcov["deviation"]}
+
+    break_dict = read_breakpoint_data(break_count, lens)
+    break_dict["contig"] = [ref] * len(break_dict["position"])
+    contig_data = {"read": read_dict, "fragment": frag_dict, "read_breakpoint": break_dict}
+
+    if fastafile is not None:
+        pileup_dict = pileup_track_cal(pileup_events, ref)
+        contig_data["pileup"] = pileup_feature_cal(pileup_dict)
+    return contig_data
+
+
+def feature_extend(feature_dict, contig_dict):
+    for key in feature_dict:
+        feature_dict[key].extend(contig_dict[key])
+
+
+worker_files = {}
+
+
+def feature_worker_init(bamfile, assemblies):
+    """
+    open the bamfile and the assemblies once per worker process
+    """
+    worker_files["bam"] = pysam.AlignmentFile(bamfile, "rb")
+    worker_files["fasta"] = pysam.FastaFile(assemblies)
+
+
+def shard_feature_cal(shard, mu, dev, pileup):
+    samfile = worker_files["bam"]
+    fastafile = worker_files["fasta"] if pileup else None
+    return [(ref, contig_feature_cal(samfile, ref, lens, mu, dev, fastafile)) for ref, lens in shard]
+
+
+def contig_shards(references, lengths, min_length, threads, done=()):
+    """
+    split contigs not done yet into shards for the worker pool, longest contigs first
+    """
+    contigs = sorted([(ref, lens) for ref, lens in zip(references, lengths) if lens >= min_length and ref not in done],
+                     key=lambda x: x[1], reverse=True)
+    shard_size = sum(lens for ref, lens in contigs) / (threads * 8)
+    shards = []
+    shard = []
+    size = 0
+    for ref, lens in contigs:
+        shard.append((ref, lens))
+        size += lens
+        if size >= shard_size:
+            shards.append(shard)
+            shard = []
+            size = 0
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def feature_dicts_init(pileup):
+    feature_dicts = {"read": {"contig": [], "start_pos": [], "read_count": [], "proper_read_count": [], "inversion_read_count": [],
+                              "clipped_read_count": [], "supplementary_read_count": [], "discordant_size_count": [], "discordant_loc_count": [], "length": []},
+                     "fragment": {"contig": [],
+                                  "start_pos": [],
+                                  "normalized_fragment_coverage": [],
+                                  "normalized_fragment_deviation": []},
+                     "read_breakpoint": {"contig": [],
+                                         "position": [],
+                                         "read_breakpoint_count": [],
+                                         "read_count": []}}
+    if pileup:
+        feature_dicts["pileup"] = window_pileup_init()
+    return feature_dicts
+
+
+def bam_feature_cal(args, mu, dev, threads):
+    """
+    calculate read, fragment coverage, read breakpoint and (without a pileup file) pileup
+    features with one traversal of the bamfile, sharding contigs over a pool of threads workers;
+    every shard is checkpointed as it completes and contigs done by an earlier run are not traversed again
+    """
+    read_file = os.path.join(args.output, "temp/read_feature/read_feature")
+    frag_file = os.path.join(args.output, "temp/coverage/fragment_coverage")
+    break_base_file = os.path.join(args.output, "temp/read_breakpoint/read_breakpoint_per_base")
+    break_window_file = os.path.join(args.output, "temp/read_breakpoint/read_breakpoint_per_window")
+    pileup_file = os.path.join(args.output, "temp/pileup/pileup_feature")
+    feature_files = [read_file, frag_file, break_window_file]
+    pileup = args.pileup is None
+    if pileup:
+        feature_files.append(pileup_file)
+    params = {"mu": mu, "dev": dev, "pileup": pileup}
+    manifest = stage_manifest(assembly_inputs(args),
+                              dict(params, min_length=args.min_length, feature_format=args.feature_format))
+    if stage_cached(args.output, "bam_feature", manifest,
+                    all(feature_exists(f, args.feature_format) for f in feature_files) and base_store_exists(break_base_file)):
         return 0
+    stage_start(args.output, "bam_feature", [break_base_file])
+    for f in feature_files:
+        feature_discard(f)
+
+    float32 = args.feature_format != "tsv"
+    checkpoint = stage_checkpoint(args.output, "bam_feature",
+                                  stage_manifest(assembly_inputs(args), dict(params, float32=float32)))
     samfile = pysam.AlignmentFile(args.bamfile, "rb")
     references = samfile.references
     lengths = samfile.lengths
-    frag_dict = {
-        "contig": [],
-        "start_pos": [],
-        "normalized_fragment_coverage": [],
-        "normalized_fragment_deviation": []}
-    for ref, lens in zip(references, lengths):
-        if lens < args.min_length:
+    assembly_index(args.assemblies)
+    shards = contig_shards(references, lengths, args.min_length, threads, contig_store_done(checkpoint))
+    with multiprocessing.Pool(processes=threads,
+                              initializer=feature_worker_init,
+                              initargs=(args.bamfile, args.assemblies,)) as pool:
+        for shard_data in pool.imap_unordered(partial(shard_feature_cal, mu=mu, dev=dev, pileup=pileup), shards):
+            feature_dicts = feature_dicts_init(pileup)
+            for ref, contig_data in shard_data:
+                for name in feature_dicts:
+                    feature_extend(feature_dicts[name], contig_data[name])
+            contig_store_append(checkpoint, [ref for ref, contig_data in shard_data],
+                                {name: pd.DataFrame(feature_dict) for name, feature_dict in feature_dicts.items()},
+                                float32)
+
+    contigs = [ref for ref, lens in zip(references, lengths) if lens >= args.min_length]
+    data = {name: contig_store_read(checkpoint, name, contigs, list(feature_dict))
+            for name, feature_dict in feature_dicts_init(pileup).items()}
+    feature_write(data["read"], read_file, args.feature_format)
+    feature_write(data["fragment"], frag_file, args.feature_format)
+    base_store_write(data["read_breakpoint"], break_base_file)
+    window_read_breakpoint_data = window_break_cal(data["read_breakpoint"])
+    feature_write(window_read_breakpoint_data, break_window_file, args.feature_format)
+    if pileup:
+        feature_write(data["pileup"], pileup_file, args.feature_format)
+    stage_done(args.output, "bam_feature", manifest)
+
+
+def KAD_shard(args, shard_file, done=()):
+    """
+    KAD and window-based KAD features of the contigs of a shard container that are long
+    enough and not done yet, and the contigs they were computed for
+    """
+    shard = ((contig, contig_seq, read_seqs) for contig, contig_seq, read_seqs in shard_contigs(shard_file)
+             if len(contig_seq) >= args.min_length and contig not in done)
+    if args.kmer_mode == "assembly":
+        shard = list(shard)
+        KAD_bulk(args, shard)
+    contigs = []
+    KAD_dict = KAD_window_init()
+    error_bound = {}
+    for contig, contig_seq, read_seqs in shard:
+        try:
+            if args.kmer_mode == "sketch":
+                error_bound[contig] = KAD_sketch(args, contig, contig_seq, read_seqs)
+            elif args.kmer_mode == "contig":
+                KAD(args, contig, contig_seq, read_seqs)
+        except subprocess.CalledProcessError:
+            # a failing k-mer counter fails every contig, so it is reported instead of skipped
+            raise
+        except BaseException:
             continue
-        reads = samfile.fetch(ref)
-        frag_coverage = fragment_coverage_cal(reads, mu, dev, lens)
-        fragcov = window_frag_cal(frag_coverage)
-        frag_dict["contig"].extend([ref] * len(fragcov['pos']))
-        frag_dict["start_pos"].extend(fragcov["pos"])
-        frag_dict["normalized_fragment_coverage"].extend(
-            fragcov["coverage"] / np.mean(fragcov["coverage"]))
-        frag_dict["normalized_fragment_deviation"].extend(fragcov["deviation"])
-    data = pd.DataFrame(frag_dict)
-    data.to_csv(os.path.join(args.output,
-                             "temp/coverage/fragment_coverage.txt"), sep="\t")
+        contigs.append(contig)
+        KAD_window_add(args, KAD_dict, contig, contig_seq)
+    return contigs, KAD_dict, error_bound
 
 
 def KAD_cal(args):
-    if os.path.exists(os.path.join(args.output,
-                                   "temp/KAD/KAD_window_data.txt")):
+    params = {"kmer_counter": args.kmer_counter, "kmer_mode": args.kmer_mode,
+              "sketch_width": args.sketch_width, "sketch_depth": args.sketch_depth}
+    manifest = stage_manifest([], dict(params, split=stage_key(args.output, "split"), min_length=args.min_length,
+                                       feature_format=args.feature_format))
+    if stage_cached(args.output, "KAD", manifest,
+                    feature_exists(os.path.join(args.output, "temp/KAD/KAD_window_data"), args.feature_format)):
         return 0
+    stage_start(args.output, "KAD")
+    feature_discard(os.path.join(args.output, "temp/KAD/KAD_window_data"))
 
-    contig_data = pd.read_csv(os.path.join(args.output,
-                                           "temp/split/contig_name.txt"), header=None)
-    split_data = pd.read_csv(os.path.join(args.output,
-                                          "temp/split/split_file_name.txt"), header=None)
-    data = pd.concat([contig_data, split_data], axis=1)
-    data.columns = ['contig', 'file']
-    data.index = data['contig']
-    contig_file = data.loc[:, 'file'].to_dict()
+    with open(os.path.join(args.output, "temp/split/shard_list.txt")) as f:
+        shard_files = f.read().split()
 
+    # per-contig KAD tables and window features are checkpointed shard by shard
+    float32 = args.feature_format != "tsv"
+    checkpoint = stage_checkpoint(args.output, "KAD", stage_manifest(assembly_inputs(args), dict(params, float32=float32)))
+    done = set(contig_store_done(checkpoint))
     os.makedirs(os.path.join(args.output, 'temp/KAD/temp'), exist_ok=True)
-    os.makedirs(os.path.join(args.output, 'temp/KAD/KAD_data'), exist_ok=True)
+    os.makedirs(os.path.join(checkpoint, 'KAD_data'), exist_ok=True)
+
+    error_bound = []
 
+    def shard_done(result):
+        contigs, KAD_dict, shard_error_bound = result
+        contig_store_append(checkpoint, contigs, {"KAD_window": pd.DataFrame(KAD_dict)}, float32)
+        error_bound.extend(bound for bound in shard_error_bound.values() if bound is not None)
+
+    failed = []
     pool = multiprocessing.Pool(processes=args.threads)
-    samfile = pysam.AlignmentFile(args.bamfile, "rb")
-    contig_len = contig_pool(samfile)
-    for contig, file in contig_file.items():
-        if contig_len[contig] < args.min_length:
-            continue
-        try:
-            t = pool.apply_async(func=KAD, args=(args, contig, file,))
-        except BaseException:
-            continue
+    for shard_file in shard_files:
+        pool.apply_async(func=KAD_shard, args=(args, shard_file, done,), callback=shard_done,
+                         error_callback=failed.append)
     pool.close()
     pool.join()
-    KAD_dict = KAD_feature(args)
-    KAD_window_data = pd.DataFrame(KAD_dict)
-    KAD_window_data.to_csv(os.path.join(args.output,
-                                        "temp/KAD/KAD_window_data.txt"), sep="\t")
+    if failed:
+        sys.stderr.write("Error: KAD calculation failed: {}\n".format(failed[0]))
+        sys.exit(1)
+    if args.kmer_mode == "sketch" and error_bound:
+        logging.getLogger('metaMIC').info(
+            "Approximate KAD: {} x {} count-min sketch, read k-mer counts overestimated by at most "
+            "{:.3g} (median over contigs {:.3g}) with probability {:.4f}".format(
+                args.sketch_depth, args.sketch_width, max(error_bound),
+                np.median(error_bound), 1 - math.exp(-args.sketch_depth)))
+    samfile = pysam.AlignmentFile(args.bamfile, "rb")
+    contigs = [ref for ref, lens in zip(samfile.references, samfile.lengths) if lens >= args.min_length]
+    KAD_window_data = contig_store_read(checkpoint, "KAD_window", contigs, list(KAD_window_init()))
+    feature_write(KAD_window_data, os.path.join(args.output, "temp/KAD/KAD_window_data"), args.feature_format)
+    stage_done(args.output, "KAD", manifest)
+
 
 def extract_features(args):
     os.makedirs(os.path.join(args.output, 'temp', 'read_feature'), exist_ok=True)
@@ -597,18 +1467,25 @@ def extract_features(args):
     os.makedirs(os.path.join(args.output, 'temp', 'pileup'), exist_ok=True)
     os.makedirs(os.path.join(args.output, 'temp', 'read_breakpoint'), exist_ok=True)
 
-    samfile = pysam.AlignmentFile(args.bamfile, "rb")
-    size_freq = fragment_distribution(samfile)
-    mu, dev = FragMAD(size_freq)
-    pool = [multiprocessing.Process(target=read_cal, args=(args, mu, dev,)),
-            multiprocessing.Process(
-        target=fragment_cal, args=(
-            args, mu, dev,)),
-            multiprocessing.Process(target=pileupfile_parse, args=(args,)),
-            multiprocessing.Process(target=read_breakpoint_cal, args=(args,)),
-            multiprocessing.Process(target=split_sam, args=(args,))]
+    mu, dev = fragment_size_cal(args)
+    # bam_feature_cal and split_sam both read the assembly through its index
+    assembly_index(args.assemblies)
+    # with a pileup file, its parser and the bam traversal run at once and share the threads
+    if args.pileup is None:
+        bam_threads = args.threads
+    else:
+        bam_threads = max(1, args.threads // 2)
+    pool = [multiprocessing.Process(target=bam_feature_cal, name="bam_feature_cal",
+                                    args=(args, mu, dev, bam_threads,)),
+            multiprocessing.Process(target=pileupfile_parse, name="pileupfile_parse",
+                                    args=(args, max(1, args.threads - bam_threads),)),
+            multiprocessing.Process(target=split_sam, name="split_sam", args=(args,))]
     for t in pool:
         t.start()
     for t in pool:
         t.join()
+    failed = [t.name for t in pool if t.exitcode != 0]
+    if failed:
+        sys.stderr.write("Error: feature extraction failed in {}\n".format(", ".join(failed)))
+        sys.exit(1)
     KAD_cal(args)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import os
+import json
+import multiprocessing
+import numpy as np
+from .store import atomic_write
+
+FOREST_ARRAYS = ["feature", "threshold", "child", "missing_left", "value"]
+
+
+def forest_flatten(models):
+    """
+    flatten the trees of a list of fitted random forests into one node array layout:
+    split feature, float32 threshold, index of the left child (the right child follows
+    it), missing-value direction and, at leaves, the probability of the second class.
+    Nodes are numbered breadth-first over all trees, so the roots come first in tree
+    order; leaves point to themselves and send every value left
+    """
+    feature = []
+    threshold = []
+    left = []
+    right = []
+    missing_left = []
+    value = []
+    model_trees = []
+    offset = 0
+    for rf in models:
+        model_trees.append(len(rf.estimators_))
+        for estimator in rf.estimators_:
+            tree = estimator.tree_
+            leaf = tree.children_left < 0
+            # a float32 threshold rounded down splits float32 values like the float64 one
+            node_threshold = tree.threshold.astype(np.float32)
+            above = node_threshold.astype(np.float64) > tree.threshold
+            node_threshold[above] = np.nextafter(node_threshold[above], np.float32(-np.inf))
+            proba = tree.value[:, 0, :]
+            normalizer = proba.sum(axis=1)
+            normalizer[normalizer == 0.0] = 1.0
+            feature.append(np.where(leaf, 0, tree.feature))
+            threshold.append(np.where(leaf, np.inf, node_threshold).astype(np.float32))
+            left.append(np.where(leaf, -1, tree.children_left + offset))
+            right.append(np.where(leaf, -1, tree.children_right + offset))
+            if hasattr(tree, "missing_go_to_left"):
+                missing_left.append(leaf | np.asarray(tree.missing_go_to_left, dtype=bool))
+            else:
+                missing_left.append(leaf)
+            value.append(np.where(leaf, proba[:, 1] / normalizer, 0))
+            offset += tree.node_count
+    left = np.concatenate(left)
+    right = np.concatenate(right)
+    roots = np.cumsum([0] + [len(f) for f in feature])[:-1]
+
+    # breadth-first numbering over all trees at once: the children of the internal
+    # nodes of a level are the next level, as consecutive (left, right) pairs
+    order = []
+    level = roots
+    depth = 0
+    while len(level) > 0:
+        order.append(level)
+        internal = level[left[level] >= 0]
+        level = np.column_stack([left[internal], right[internal]]).ravel()
+        depth += 1
+    order = np.concatenate(order)
+    number = np.empty(len(order), dtype=np.int64)
+    number[order] = np.arange(len(order))
+    child = np.where(left >= 0, number[np.maximum(left, 0)], number)[order]
+
+    feature_names = getattr(models[0], "feature_names_in_", None)
+    forest = {"feature": np.concatenate(feature).astype(np.int32)[order],
+              "threshold": np.concatenate(threshold)[order],
+              "child": child.astype(np.int64),
+              "missing_left": np.concatenate(missing_left)[order],
+              "value": np.concatenate(value)[order],
+              "model_trees": model_trees,
+              "max_depth": depth - 1,
+              "n_features": int(models[0].n_features_in_),
+              "feature_names": None if feature_names is None else [str(name) for name in feature_names]}
+    return forest
+
+
+def forest_write(forest, path):
+    """
+    write a flattened forest as a directory of .npy node arrays, which can be
+    memory-mapped, and a json file with the number of trees of each model
+    """
+    def write(tmp):
+        os.makedirs(tmp)
+        for name in FOREST_ARRAYS:
+            np.save(os.path.join(tmp, "{}.npy".format(name)), forest[name])
+        with open(os.path.join(tmp, "forest.json"), "w") as f:
+            json.dump({name: forest[name] for name in forest if name not in FOREST_ARRAYS + ["path"]}, f)
+    atomic_write(path, write)
+
+
+def forest_read(path):
+    forest = {name: np.load(os.path.join(path, "{}.npy".format(name)), mmap_mode="r") for name in FOREST_ARRAYS}
+    with open(os.path.join(path, "forest.json")) as f:
+        forest.update(json.load(f))
+    forest["path"] = path
+    return forest
+
+
+def forest_apply(forest, x, trees):
+    """
+    leaf reached by every row of x in each of the given trees, moving all pairs of rows
+    and trees one level down the node arrays per step; as in sklearn, rows are compared
+    as float32 and missing values follow missing_left
+    """
+    x = np.asarray(x, dtype=np.float32)
+    leaf = np.tile(np.asarray(trees, dtype=np.int64), len(x))
+    base = np.repeat(np.arange(len(x), dtype=np.int64) * x.shape[1], len(trees))
+    x = x.ravel()
+    missing = bool(np.isnan(x).any())
+    # pairs still inside their tree; those at a leaf are dropped every few levels
+    pair = np.arange(len(leaf))
+    node = leaf
+    for depth in range(forest["max_depth"]):
+        values = x[base + forest["feature"][node]]
+        go_right = ~(values <= forest["threshold"][node])
+        if missing:
+            go_right &= ~(np.isnan(values) & forest["missing_left"][node])
+        node = forest["child"][node] + go_right
+        if depth % 4 == 3:
+            inner = forest["threshold"][node] != np.inf
+            leaf[pair] = node
+            pair = pair[inner]
+            node = node[inner]
+            base = base[inner]
+    leaf[pair] = node
+    return leaf.reshape(-1, len(trees))
+
+
+def forest_model_score(forest, x, model):
+    """
+    probability of the second class of every row of x under one model, as predict_proba
+    of the random forest computes it: tree probabilities are added up in tree order and
+    divided by the number of trees
+    """
+    bounds = np.cumsum([0] + list(forest["model_trees"]))
+    proba = forest["value"][forest_apply(forest, x, np.arange(bounds[model], bounds[model + 1]))]
+    return np.cumsum(proba, axis=1)[:, -1] / (bounds[model + 1] - bounds[model])
+
+
+worker_forest = {}
+
+
+def forest_worker_init(forest):
+    """
+    open the flattened forest once per worker process, memory-mapped when it was read from disk
+    """
+    worker_forest["forest"] = forest_read(forest["path"]) if "path" in forest else forest
+
+
+def forest_worker_score(task):
+    start, x, model = task
+    return start, model, forest_model_score(worker_forest["forest"], x, model)
+
+
+def forest_matrix(forest, X):
+    if forest["feature_names"] is not None and hasattr(X, "columns"):
+        X = X.loc[:, forest["feature_names"]]
+    return np.asarray(X, dtype=np.float32)
+
+
+def forest_pool(forest, threads):
+    source = {"path": forest["path"]} if "path" in forest else forest
+    return multiprocessing.Pool(processes=threads, initializer=forest_worker_init, initargs=(source,))
+
+
+def forest_score(forest, X, models, chunk_size, threads, pool=None):
+    """
+    rows x models matrix of the probabilities of the second class of every row of X under
+    the given models; every task scores a chunk of rows against all trees of one model,
+    with about chunk_size (row, tree) pairs and at least four tasks per worker, so scores
+    do not depend on the number of threads
+    """
+    score = np.zeros((X.shape[0], len(models)))
+    rows = max(1, min(chunk_size // max(forest["model_trees"]), -(-X.shape[0] * len(models) // (4 * threads))))
+    tasks = ((start, X[start:start + rows], model) for start in range(0, X.shape[0], rows) for model in models)
+    if pool is not None:
+        for start, model, model_score in pool.imap_unordered(forest_worker_score, tasks):
+            score[start:start + len(model_score), models.index(model)] = model_score
+    else:
+        for start, x, model in tasks:
+            score[start:start + len(x), models.index(model)] = forest_model_score(forest, x, model)
+    return score
+
+
+def forest_predict(forest, X, chunk_size=1 << 21, threads=1):
+    """
+    probability of the second class of every row of X under each model
+    """
+    X = forest_matrix(forest, X)
+    models = list(range(len(forest["model_trees"])))
+    if threads <= 1:
+        return forest_score(forest, X, models, chunk_size, threads)
+    with forest_pool(forest, threads) as pool:
+        return forest_score(forest, X, models, chunk_size, threads, pool)
+
+
+def forest_cascade(forest, X, cut, chunk_size=1 << 21, threads=1):
+    """
+    probability of the second class of every row of X under each model, evaluating the
+    models in turn and stopping for a row once its mean score cannot exceed cut even if
+    all remaining models gave it probability 1; the scores left out are NaN
+    """
+    X = forest_matrix(forest, X)
+    n_models = len(forest["model_trees"])
+    score = np.full((X.shape[0], n_models), np.nan)
+    total = np.zeros(X.shape[0])
+    active = np.arange(X.shape[0])
+    pool = forest_pool(forest, threads) if threads > 1 else None
+    try:
+        for model in range(n_models):
+            if len(active) == 0:
+                break
+            model_score = forest_score(forest, X[active], [model], chunk_size, threads, pool)[:, 0]
+            score[active, model] = model_score
+            total[active] += model_score
+            # the margin keeps rounding in the final mean from crossing the cut
+            active = active[(total[active] + n_models - model - 1) / n_models > cut - 1e-9]
+    finally:
+        if pool is not None:
+            pool.terminate()
+    return score
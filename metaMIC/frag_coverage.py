@@ -10,6 +10,11 @@ import warnings
 import pysam
 import collections
 import multiprocessing
+try:
+    from .window import window_starts, window_mean, window_var, coverage_track
+except ImportError:
+    # run as a script, the package directory itself is on sys.path
+    from window import window_starts, window_mean, window_var, coverage_track
 
 def parseargs():
     parser=argparse.ArgumentParser(description="Calculate coverage/fragment coverage of assemblies")
@@ -119,40 +124,34 @@ def discordant_size_count(args,contig_frag,mu,dev):
 def fragment_coverage_per_contig(args,length,reads,mu,dev):
     """
     calculate fragment coverage per contig
-    """    
-    frag_coverage = [0]*length
+    """
+    frag_start = []
+    frag_end = []
     for read in reads:
         if read.cigarstring!=None:
             if read.rnext == read.tid:
                 if (mu - 3*dev <= abs(read.isize) <= mu + 3*dev) and read.is_proper_pair and read.next_reference_start < read.reference_start:
                     if read.next_reference_start + read.rlen < read.reference_start:
-                        for i in range(read.next_reference_start + read.rlen, read.reference_start):
-                            frag_coverage[i]+=1
+                        frag_start.append(read.next_reference_start + read.rlen)
+                        frag_end.append(read.reference_start)
                     else:
-                        for i in range(read.next_reference_start,read.reference_end):
-                            frag_coverage[i]+=1
+                        frag_start.append(read.next_reference_start)
+                        frag_end.append(read.reference_end)
+    frag_coverage = coverage_track(frag_start,frag_end,length)
     frag_dict = window_coverage_cal(args,frag_coverage)
-    return frag_dict     
-    
+    return frag_dict
+
 def window_coverage_cal(args,coverage):
     """
     Using sliding window approach to smooth out features
-    """               
+    """
+    starts = window_starts(len(coverage))
+    moving_sum_array = window_mean(coverage,starts)
+    moving_dev_array = np.sqrt(window_var(coverage,starts))/moving_sum_array
     cov = {}
-    moving_sum_array = []
-    moving_dev_array = []
-    pos  = []
-    for i in range(300,len(coverage),100):
-        start=i
-        end = i + 100
-        moving_sum_array.append(np.mean(coverage[start:end]))
-        moving_dev_array.append(np.sqrt(np.var(coverage[start:end]))/np.mean(coverage[start:end]))
-        pos.append(start)
-        if len(coverage) - end <= 300:
-            break
     cov["coverage"] = moving_sum_array
-    cov["deviation"] = moving_dev_array      
-    cov["pos"]=pos
+    cov["deviation"] = moving_dev_array
+    cov["pos"]=list(starts)
     return cov 
                         
 def fragment_coverage(args,samfile,mu,dev):
@@ -176,7 +175,7 @@ def fragment_coverage(args,samfile,mu,dev):
         position.extend(fragcov['pos'])
     data=pd.DataFrame({"contig":contigs,"start_pos":position,
     "normalized_fragment_coverage":norm_fragcov,"normalized_fragment_deviation":norm_fragdev})
-    os.makedirs(os.path.join(args.output, "temp/coverage/"))
+    os.makedirs(os.path.join(args.output, "temp/coverage/"), exist_ok=True)
     data.to_csv(os.path.join(args.output, "temp/coverage/fragment_coverage.txt"),sep="\t")
                
 def contig_index(data):
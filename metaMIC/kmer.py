@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+KMER_SIZE = 25
+BASE_CODE = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate([b'Aa', b'Cc', b'Gg', b'Tt']):
+    for base in bases:
+        BASE_CODE[base] = code
+
+
+def kmer_scan(seq, k=KMER_SIZE):
+    """
+    rolling 2-bit packed uint64 values of the k-mers starting at every position of a
+    sequence, and whether each k-mer consists of ACGT bases only
+    """
+    data = BASE_CODE[np.frombuffer(seq.encode(), dtype=np.uint8)]
+    n = len(data) - k + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    invalid = np.concatenate([[0], np.cumsum(data == 4)])
+    valid = invalid[k:] - invalid[:-k] == 0
+    base = data.astype(np.uint64) & np.uint64(3)
+    kmers = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        kmers = (kmers << np.uint64(2)) | base[j:j + n]
+    return kmers, valid
+
+
+def kmer_encode(seqs, k=KMER_SIZE):
+    """
+    2-bit packed uint64 values of all forward-strand k-mers of the sequences, skipping
+    k-mers with non-ACGT bases
+    """
+    kmers, valid = kmer_scan('N'.join(seqs), k)
+    return kmers[valid]
+
+
+def seq_batches(seqs, chunk_size):
+    """
+    lists of consecutive sequences with about chunk_size bases each
+    """
+    batch = []
+    batch_len = 0
+    for seq in seqs:
+        batch.append(seq)
+        batch_len += len(seq)
+        if batch_len >= chunk_size:
+            yield batch
+            batch = []
+            batch_len = 0
+    yield batch
+
+
+def kmer_count(seqs, k=KMER_SIZE, chunk_size=1 << 24):
+    """
+    sorted unique k-mers of the sequences and their counts, counted with sort/unique
+    over chunks of about chunk_size bases
+    """
+    kmers = []
+    counts = []
+    for batch in seq_batches(seqs, chunk_size):
+        uniq, count = np.unique(kmer_encode(batch, k), return_counts=True)
+        kmers.append(uniq)
+        counts.append(count)
+    if len(kmers) == 1:
+        return kmers[0], counts[0]
+    uniq, index = np.unique(np.concatenate(kmers), return_inverse=True)
+    return uniq, np.bincount(index, weights=np.concatenate(counts)).astype(np.int64)
+
+
+def sketch_hash(kmers, depth, width):
+    """
+    column of every k-mer in each of the depth rows of a count-min sketch,
+    by multiply-shift hashing with fixed odd multipliers
+    """
+    multipliers = np.random.RandomState(0).randint(0, 1 << 62, size=depth, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    return [((kmers * multiplier) >> np.uint64(32)) % np.uint64(width) for multiplier in multipliers]
+
+
+def kmer_sketch(seqs, width, depth, k=KMER_SIZE, chunk_size=1 << 24):
+    """
+    count-min sketch (depth x width counters) of the k-mers of the sequences and the
+    total number of k-mers added; sequences are consumed in batches of about chunk_size
+    bases, so memory is fixed by width, depth and chunk_size
+    """
+    table = np.zeros((depth, width), dtype=np.uint32)
+    total = 0
+    for batch in seq_batches(seqs, chunk_size):
+        kmers = kmer_encode(batch, k)
+        for row, column in enumerate(sketch_hash(kmers, depth, width)):
+            table[row] += np.bincount(column.astype(np.int64), minlength=width).astype(np.uint32)
+        total += len(kmers)
+    return table, total
+
+
+def sketch_query(table, kmers):
+    """
+    estimated counts of k-mers in a count-min sketch, never below the true counts
+    """
+    depth, width = table.shape
+    if len(kmers) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.min([table[row][column] for row, column in enumerate(sketch_hash(kmers, depth, width))],
+                  axis=0).astype(np.int64)
+
+
+def group_unique(groups, kmers, counts):
+    """
+    sorted unique (group, k-mer) pairs and their summed counts
+    """
+    order = np.lexsort((kmers, groups))
+    groups = groups[order]
+    kmers = kmers[order]
+    counts = counts[order]
+    first = np.ones(len(kmers), dtype=bool)
+    first[1:] = (groups[1:] != groups[:-1]) | (kmers[1:] != kmers[:-1])
+    index = np.flatnonzero(first)
+    if len(index) == 0:
+        return groups, kmers, counts
+    return groups[index], kmers[index], np.add.reduceat(counts, index)
+
+
+def kmer_group_count(seqs, groups, k=KMER_SIZE, chunk_size=1 << 24):
+    """
+    sorted unique (group, k-mer) pairs of sequences that each belong to a group, such as
+    the contig a read is mapped to, and their counts
+    """
+    parts = []
+
+    def batch_count(batch, batch_groups):
+        kmers, valid = kmer_scan('N'.join(batch), k)
+        offsets = np.cumsum([0] + [len(seq) + 1 for seq in batch])
+        seq_index = np.searchsorted(offsets, np.arange(len(kmers)), side='right') - 1
+        parts.append(group_unique(np.asarray(batch_groups, dtype=np.int64)[seq_index[valid]],
+                                  kmers[valid], np.ones(int(valid.sum()), dtype=np.int64)))
+
+    batch = []
+    batch_groups = []
+    batch_len = 0
+    for seq, group in zip(seqs, groups):
+        batch.append(seq)
+        batch_groups.append(group)
+        batch_len += len(seq)
+        if batch_len >= chunk_size:
+            batch_count(batch, batch_groups)
+            batch = []
+            batch_groups = []
+            batch_len = 0
+    batch_count(batch, batch_groups)
+    if len(parts) == 1:
+        return parts[0]
+    return group_unique(*[np.concatenate(part) for part in zip(*parts)])
+
+
+def kmer_dump_parse(block, k=KMER_SIZE):
+    """
+    2-bit packed k-mers and counts of a byte block of complete 'jellyfish dump -c -t' lines
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    line_end = np.flatnonzero(data == ord('\n'))
+    line_start = np.concatenate([[0], line_end[:-1] + 1]).astype(np.int64)
+    base = (BASE_CODE[data[line_start[:, None] + np.arange(k)]] & 3).astype(np.uint64)
+    kmers = np.zeros(len(line_start), dtype=np.uint64)
+    for j in range(k):
+        kmers = (kmers << np.uint64(2)) | base[:, j]
+    count_start = line_start + k + 1
+    count_width = line_end - count_start
+    counts = np.zeros(len(line_start), dtype=np.int64)
+    for j in range(count_width.max(initial=0)):
+        digit = data[np.minimum(count_start + j, len(data) - 1)].astype(np.int64) - ord('0')
+        counts = np.where(j < count_width, counts * 10 + digit, counts)
+    return kmers, counts
+
+
+def kmer_dump_read(stream, k=KMER_SIZE, block_size=1 << 24):
+    """
+    sorted k-mers and counts of 'jellyfish dump -c -t' output read from a stream in blocks
+    """
+    kmers = [np.zeros(0, dtype=np.uint64)]
+    counts = [np.zeros(0, dtype=np.int64)]
+    rest = b''
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        block = rest + block
+        cut = block.rfind(b'\n') + 1
+        rest = block[cut:]
+        if cut > 0:
+            block_kmers, block_counts = kmer_dump_parse(block[:cut], k)
+            kmers.append(block_kmers)
+            counts.append(block_counts)
+    kmers = np.concatenate(kmers)
+    counts = np.concatenate(counts)
+    order = np.argsort(kmers)
+    return kmers[order], counts[order]
+
+
+def kmer_lookup(kmers, valid, pool_kmer):
+    """
+    index of every k-mer in the sorted pool_kmer array, and whether it was found there
+    """
+    if len(pool_kmer) == 0:
+        return np.zeros(len(kmers), dtype=np.int64), np.zeros(len(kmers), dtype=bool)
+    index = np.minimum(np.searchsorted(pool_kmer, kmers), len(pool_kmer) - 1)
+    return index, valid & (pool_kmer[index] == kmers)
@@ -21,6 +21,7 @@ import joblib
 import warnings
 from sklearn.ensemble import IsolationForest
 from scipy import stats
+from scipy import sparse
 import logging
 import hashlib
 import requests
@@ -28,6 +29,10 @@ import shutil
 import tarfile
 import gzip
 from .extract import extract_features
+from .forest import forest_flatten, forest_write, forest_read, forest_predict, forest_cascade
+from .store import FEATURE_FORMATS, format_available, feature_path, feature_exists, feature_discard, feature_read, \
+    feature_write, feature_chunks, feature_write_chunks, base_store_exists, base_store_read, atomic_write
+from .cache import stage_manifest, stage_key, stage_cached, stage_start, stage_done, stage_params
 
 base_path = os.path.split(__file__)[0]
 contig_features = [
@@ -153,9 +158,8 @@ def get_opts(args):
     extract_feature.add_argument(
         "--pileup",
         dest="pileup",
-        default='pileup',
-        required=True,
-        help="path to pileup file [samtools mpileup]")
+        required=False,
+        help="path to pileup file [samtools mpileup]; pileup features are computed from the bam file if not given")
 
     extract_feature.add_argument(
         "-m",
@@ -174,6 +178,14 @@ def get_opts(args):
         required=False,
         help='Minimum contig length [default: 5000bp]')
 
+    extract_feature.add_argument(
+        "--sample_pairs",
+        dest="sample_pairs",
+        type=int,
+        default=0,
+        required=False,
+        help='Estimate the fragment size distribution from this many read pairs sampled across contigs [default: 0, all reads]')
+
     extract_feature.add_argument(
         "--samtools",
         dest="samtools",
@@ -188,6 +200,46 @@ def get_opts(args):
         default="jellyfish",
         help="path to jellyfish")
 
+    extract_feature.add_argument(
+        "--kmer_counter",
+        dest="kmer_counter",
+        required=False,
+        default="numpy",
+        choices=["numpy", "jellyfish"],
+        help="k-mer counter used for KAD features [numpy/jellyfish, default: numpy]")
+
+    extract_feature.add_argument(
+        "--kmer_mode",
+        dest="kmer_mode",
+        required=False,
+        default="contig",
+        choices=["contig", "assembly", "sketch"],
+        help="count k-mers for KAD features per contig, in bulk for all contigs of a shard, or per contig with read k-mer counts approximated by a count-min sketch of fixed size; assembly and sketch use the numpy counter [contig/assembly/sketch, default: contig]")
+
+    extract_feature.add_argument(
+        "--sketch_width",
+        dest="sketch_width",
+        type=int,
+        required=False,
+        default=1 << 24,
+        help="Number of counters per row of the count-min sketch in sketch mode [default: 16777216]")
+
+    extract_feature.add_argument(
+        "--sketch_depth",
+        dest="sketch_depth",
+        type=int,
+        required=False,
+        default=4,
+        help="Number of rows of the count-min sketch in sketch mode; each worker holds 4 x width x depth bytes [default: 4]")
+
+    extract_feature.add_argument(
+        "--feature_format",
+        dest="feature_format",
+        required=False,
+        default="npz",
+        choices=list(FEATURE_FORMATS),
+        help="Format of feature tables in temp/ and feature_matrix/; parquet requires pyarrow [npz/parquet/tsv, default: npz]")
+
 
 
     predict = subparsers.add_parser('predict',
@@ -264,6 +316,22 @@ def get_opts(args):
         default=0.9,
         help='Threshold of anomaly score for correcting misassemblies in metagenomics')
 
+    predict.add_argument(
+        "-t",
+        "--threads",
+        dest="threads",
+        required=False,
+        type=int,
+        default=8,
+        help='Maximum number of threads for scoring contigs and windows [default: 8]')
+
+    predict.add_argument(
+        "--cascade",
+        dest="cascade",
+        required=False,
+        action="store_true",
+        help="Evaluate the models in turn and stop for contigs whose score cannot exceed the score cutoff, which are reported with an NA score; needs the MEGAHIT or IDBA_UD model")
+
 
     train = subparsers.add_parser('train',
                                   help='Train model.')
@@ -348,6 +416,7 @@ def download_model(path, MD5):
                 sys.stderr.write("Error: cannot unzip the file.")
                 sys.exit(1)
             os.remove(os.path.join(os.path.join(base_path, 'model', os.path.split(path)[1].split('.')[0]),temp_gz))
+        export_forest(os.path.join(base_path, 'model', os.path.split(path)[1].split('.')[0]))
 
     else:
         os.remove(download_path)
@@ -362,13 +431,21 @@ def download():
 
 def filter_contig(options):
     """
-    remove assemblies with length smaller than required minimal length
+    remove assemblies with length smaller than required minimal length; the filtered copy
+    is rebuilt whenever the assemblies given with -c or the minimal length change, which in
+    turn invalidates the stages fingerprinting it
     """
-    input = SeqIO.parse(options.assemblies, "fasta")
-    input = (record for record in input if len(record.seq) > 1000)
-    os.makedirs(os.path.join(options.output, "temp/contig"), exist_ok=True)
-    SeqIO.write(input, os.path.join(options.output, "temp/contig/filtered_contigs.fa"), "fasta")
-    options.assemblies = os.path.join(options.output, "temp/contig/filtered_contigs.fa")
+    filtered = os.path.join(options.output, "temp/contig/filtered_contigs.fa")
+    # contigs over 1000bp are always kept, shorter ones only if --mlen asks for them
+    min_length = min(options.min_length, 1001)
+    manifest = stage_manifest([options.assemblies], {"min_length": min_length})
+    if not stage_cached(options.output, "filter_contig", manifest, os.path.exists(filtered)):
+        input = SeqIO.parse(options.assemblies, "fasta")
+        input = (record for record in input if len(record.seq) >= min_length)
+        os.makedirs(os.path.join(options.output, "temp/contig"), exist_ok=True)
+        atomic_write(filtered, lambda tmp: SeqIO.write(input, tmp, "fasta"))
+        stage_done(options.output, "filter_contig", manifest)
+    options.assemblies = filtered
     return options
 
 
@@ -399,90 +476,180 @@ def extract_feature(options):
     """
     Extract four types of features from bamfiles and generate contig-based/window-based feature matrix
     """
-    # check if feature file exists
-    status = feature_exist(options)
-    if status:
-        print("feature files exist and will not re-extract features")
-    else:
-        extract_features(options)
-        # check output features
-        check_feature(options)
+    # stages whose inputs, parameters and code are unchanged since their last run are skipped
+    extract_features(options)
+    # check output features
+    check_feature(options)
     # Generate contig-based/window-based matrix
-    if options.mode == 'single':
-        window_matrix = cal_feature(options)
-    else:
-        window_matrix, contig_matrix = cal_feature(options)
+    cal_feature(options)
 
 
 def cov_thread_cal(data):
-    up = np.percentile(np.array(data), 95)
-    low = np.percentile(np.array(data), 5)
+    up, low = np.percentile(np.array(data), [95, 5])
     return up, low
 
 
-def contig_fea_generate(data):
-    # Generate contig-based feature matrix
-    grouped = data.groupby(['contig'])
-    mean_data = grouped.mean()
-    mean_data = mean_data.loc[:, mean_data.columns != 'start_pos']
-    data['count'] = 1
-    data['proper_status'] = data['proper_read_ratio'] <= 0.9
-    data['clipped_status'] = data['clipped_read_ratio'] >= 0.1
-    data['supplementary_status'] = data['supplementary_read_ratio'] >= 0.1
-    data['inversion_status'] = data['inversion_read_ratio'] >= 0.1
-    data['discordant_loc_status'] = data['discordant_loc_ratio'] >= 0.1
-    data['discordant_size_status'] = data['discordant_size_ratio'] >= 0.1
-    data['KAD_status'] = data['mean_KAD'] > 0.75
-    data['disagree_status'] = data['disagree_portion'] > 0.1
-    data['coverage_status'] = (data['normalized_coverage'] > cov_thread_cal(list(data['normalized_coverage']))[0]) + \
-                              (data['normalized_coverage'] < cov_thread_cal(list(data['normalized_coverage']))[1])
-    data['fragment_status'] = (data['normalized_fragment_coverage'] > cov_thread_cal(list(data['normalized_fragment_coverage']))[0]) + \
-                              (data['normalized_fragment_coverage'] < cov_thread_cal(list(data['normalized_fragment_coverage']))[1])
-    data['deviation_status'] = data['normalized_deviation'] > cov_thread_cal(list(data['normalized_deviation']))[0]
-    data['fragment_deviation_status'] = data['normalized_fragment_deviation'] > cov_thread_cal(
-        list(data['normalized_fragment_deviation']))[0]
-    grouped = data.groupby(['contig'])
-    width_data = pd.concat([grouped['proper_status'].sum() /
-                            grouped['count'].sum(), grouped['clipped_status'].sum() /
-                            grouped['count'].sum(), grouped['supplementary_status'].sum() /
-                            grouped['count'].sum(), grouped['inversion_status'].sum() /
-                            grouped['count'].sum(), grouped['discordant_loc_status'].sum() /
-                            grouped['count'].sum(), grouped['discordant_size_status'].sum() /
-                            grouped['count'].sum(), grouped['KAD_status'].sum() /
-                            grouped['count'].sum(), grouped['disagree_status'].sum() /
-                            grouped['count'].sum(), grouped['coverage_status'].sum() /
-                            grouped['count'].sum(), grouped['fragment_status'].sum() /
-                            grouped['count'].sum(), grouped['deviation_status'].sum() /
-                            grouped['count'].sum(), grouped['fragment_deviation_status'].sum() /
-                            grouped['count'].sum()], axis=1)
-    width_data.columns = [
-        'proper_read_width',
-        'clipped_read_width',
-        'supplementary_read_width',
-        'inversion_read_width',
-        'discordant_loc_width',
-        'discordant_size_width',
-        'KAD_width',
-        'disagree_width',
-        'coverage_width',
-        'fragment_width',
-        'deviation_width',
-        'fragment_deviation_width']
-    dev_data = pd.concat([pd.DataFrame(np.sqrt(grouped['normalized_coverage'].var())),
-                          pd.DataFrame(np.sqrt(grouped['normalized_fragment_coverage'].var()))], axis=1)
-    dev_data.columns = ['window_cov_dev', 'window_frag_cov_dev']
-    break_data = pd.DataFrame(grouped['read_breakpoint_ratio'].max())
-    break_data.columns = ['read_breakpoint_max']
-    contig_data = pd.concat([mean_data, width_data, dev_data, break_data], axis=1)
+def window_thresholds(chunks):
+    """
+    95th and 5th percentiles over all windows of the coverage and deviation features
+    that mark abnormal windows, gathered from row chunks of the window-based feature matrix
+    """
+    columns = ['normalized_coverage', 'normalized_fragment_coverage',
+               'normalized_deviation', 'normalized_fragment_deviation']
+    values = {col: [] for col in columns}
+    for chunk in chunks:
+        for col in columns:
+            values[col].append(np.asarray(chunk[col]))
+    thresholds = {}
+    for col in columns:
+        data = np.concatenate(values[col]) if values[col] else np.zeros(0)
+        thresholds[col] = cov_thread_cal(data) if len(data) > 0 else (np.nan, np.nan)
+    return thresholds
+
+
+def contig_chunks(chunks):
+    """
+    regroup row chunks of a window table stored contig by contig into chunks of whole contigs
+    """
+    rest = None
+    for chunk in chunks:
+        if rest is not None:
+            chunk = pd.concat([rest, chunk])
+        if chunk.shape[0] == 0:
+            continue
+        contig = chunk['contig'].values
+        # the last contig of a chunk may continue in the next one
+        cut = np.flatnonzero(contig != contig[-1])
+        cut = cut[-1] + 1 if len(cut) > 0 else 0
+        if cut > 0:
+            yield chunk.iloc[:cut]
+        rest = chunk.iloc[cut:]
+    if rest is not None and rest.shape[0] > 0:
+        yield rest
+
+
+def contig_fea_generate(data, thresholds=None):
+    """
+    Generate contig-based feature matrix: per-contig means of the window features, fractions
+    of abnormal windows, window coverage deviations and the maximal read breakpoint ratio,
+    reduced in one grouped pass over integer contig codes; abnormal coverage is judged against
+    the thresholds of all windows, by default those of data
+    """
+    if data.shape[0] == 0:
+        return pd.DataFrame(columns=contig_features, index=pd.Index([], name='contig'))
+    if thresholds is None:
+        thresholds = window_thresholds([data])
+    codes, contigs = pd.factorize(data['contig'], sort=True)
+    nwindow = data.shape[0]
+    # indicator matrix of the contig of every window: a product with it sums windows per contig
+    contig_window = sparse.csr_matrix((np.ones(nwindow), (codes, np.arange(nwindow))),
+                                      shape=(len(contigs), nwindow))
+
+    cov_up, cov_low = thresholds['normalized_coverage']
+    frag_up, frag_low = thresholds['normalized_fragment_coverage']
+    dev_up = thresholds['normalized_deviation'][0]
+    frag_dev_up = thresholds['normalized_fragment_deviation'][0]
+    status = {'proper_read_width': data['proper_read_ratio'] <= 0.9,
+              'clipped_read_width': data['clipped_read_ratio'] >= 0.1,
+              'supplementary_read_width': data['supplementary_read_ratio'] >= 0.1,
+              'inversion_read_width': data['inversion_read_ratio'] >= 0.1,
+              'discordant_loc_width': data['discordant_loc_ratio'] >= 0.1,
+              'discordant_size_width': data['discordant_size_ratio'] >= 0.1,
+              'KAD_width': data['mean_KAD'] > 0.75,
+              'disagree_width': data['disagree_portion'] > 0.1,
+              'coverage_width': (data['normalized_coverage'] > cov_up) | (data['normalized_coverage'] < cov_low),
+              'fragment_width': (data['normalized_fragment_coverage'] > frag_up) |
+                                (data['normalized_fragment_coverage'] < frag_low),
+              'deviation_width': data['normalized_deviation'] > dev_up,
+              'fragment_deviation_width': data['normalized_fragment_deviation'] > frag_dev_up}
+    status_data = np.column_stack(list(status.values()))
+
+    # means skip missing values like groupby().mean()
+    mean_columns = [col for col in contig_features if col in data.columns]
+    mean_data = data.loc[:, mean_columns].to_numpy(dtype=float)
+    mean_valid = ~np.isnan(mean_data)
+    # coverage deviations are computed on values shifted by the first window of each contig
+    dev_data = data.loc[:, ['normalized_coverage', 'normalized_fragment_coverage']].to_numpy(dtype=float)
+    first = np.full(len(contigs), nwindow)
+    np.minimum.at(first, codes, np.arange(nwindow))
+    shift = dev_data[first]
+    dev_data = dev_data - np.where(np.isfinite(shift), shift, 0)[codes]
+    dev_valid = ~np.isnan(dev_data)
+    dev_data = np.where(dev_valid, dev_data, 0)
+
+    sums = contig_window @ np.concatenate([np.where(mean_valid, mean_data, 0), mean_valid, status_data,
+                                           dev_data, dev_data ** 2, dev_valid, np.ones((nwindow, 1))], axis=1)
+    nmean = len(mean_columns)
+    nstatus = status_data.shape[1]
+    sums = np.split(sums.T, np.cumsum([nmean, nmean, nstatus, 2, 2, 2]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        contig_data = dict(zip(mean_columns, sums[0] / sums[1]))
+        contig_data.update(zip(status, sums[2] / sums[6]))
+        dev_sum, dev_square, dev_count = sums[3], sums[4], sums[5]
+        var = np.maximum(dev_square - dev_sum ** 2 / dev_count, 0) / (dev_count - 1)
+        var[dev_count < 2] = np.nan
+    contig_data['window_cov_dev'] = np.sqrt(var[0])
+    contig_data['window_frag_cov_dev'] = np.sqrt(var[1])
+    contig_data['read_breakpoint_max'] = np.full(len(contigs), np.nan)
+    np.fmax.at(contig_data['read_breakpoint_max'], codes, data['read_breakpoint_ratio'].to_numpy(dtype=float))
+    contig_data = pd.DataFrame(contig_data, index=pd.Index(contigs, name='contig'))
     contig_data = contig_data.loc[:, contig_features]
     contig_data = contig_data.fillna(0)
     contig_data = contig_data.replace(np.inf, 0)
     return contig_data
 
 
-def cal_feature(options):
-    read_feature = pd.read_csv(os.path.join(options.output,
-                                            "temp/read_feature/read_feature.txt"), sep="\t", index_col=0)
+def window_table_chunks(tables, contig_id, fmt):
+    """
+    k-way merge of window tables stored in reference order in format fmt: yields, for one
+    chunk of whole contigs at a time, the rows of these contigs in every table; a contig is
+    complete once every table has read past it
+    """
+    readers = [feature_chunks(table, fmt) for table in tables]
+    buffers = [None] * len(tables)
+    exhausted = [False] * len(tables)
+
+    def refill(i):
+        chunk = next(readers[i], None)
+        if chunk is None:
+            exhausted[i] = True
+            return
+        ids = chunk['contig'].map(contig_id).values
+        if np.any(ids[1:] < ids[:-1]) or (buffers[i] is not None and len(ids) > 0 and
+                                           len(buffers[i][1]) > 0 and ids[0] < buffers[i][1][-1]):
+            sys.stderr.write("Error: {} is not in reference order\n".format(tables[i]))
+            sys.exit(1)
+        if buffers[i] is not None:
+            chunk = pd.concat([buffers[i][0], chunk])
+            ids = np.concatenate([buffers[i][1], ids])
+        buffers[i] = (chunk, ids)
+
+    while True:
+        for i in range(len(tables)):
+            while not exhausted[i] and (buffers[i] is None or len(buffers[i][1]) == 0):
+                refill(i)
+        # the last contig read from a table may continue in its next chunk
+        bounds = [np.inf if exhausted[i] else buffers[i][1][-1] - 1 for i in range(len(tables))]
+        bound = min(bounds)
+        if bound >= 0:
+            chunks = []
+            for i in range(len(tables)):
+                chunk, ids = buffers[i]
+                cut = np.searchsorted(ids, bound, side='right')
+                chunks.append(chunk.iloc[:cut])
+                buffers[i] = (chunk.iloc[cut:], ids[cut:])
+            if any(len(chunk) > 0 for chunk in chunks) or bound == np.inf:
+                yield chunks
+        if bound == np.inf:
+            break
+        refill(bounds.index(bound))
+
+
+def window_merge(read_feature, frag_coverage, pileup_feature, KAD_feature, breakpoint_data):
+    """
+    window-based feature matrix of the windows of a chunk of contigs
+    """
+    read_feature = read_feature.copy()
     read_feature['proper_read_ratio'] = read_feature['proper_read_count'] / read_feature['read_count']
     read_feature['inversion_read_ratio'] = read_feature['inversion_read_count'] / read_feature['proper_read_count']
     read_feature['clipped_read_ratio'] = read_feature['clipped_read_count'] / read_feature['proper_read_count']
@@ -498,15 +665,6 @@ def cal_feature(options):
                                          'discordant_loc_ratio',
                                          'discordant_size_ratio',
                                          'length']]
-
-    frag_coverage = pd.read_csv(os.path.join(options.output,
-                                             "temp/coverage/fragment_coverage.txt"), sep="\t", index_col=0)
-    pileup_feature = pd.read_csv(os.path.join(options.output,
-                                              "temp/pileup/pileup_feature.txt"), sep="\t", index_col=0)
-    KAD_feature = pd.read_csv(os.path.join(options.output,
-                                           "temp/KAD/KAD_window_data.txt"), sep="\t", index_col=0)
-    breakpoint_data = pd.read_csv(os.path.join(options.output,
-                                               "temp/read_breakpoint/read_breakpoint_per_window.txt"), sep="\t", index_col=0)
     window_data = pd.merge(window_read_data, frag_coverage, on=['contig', 'start_pos'])
     window_data = pd.merge(window_data, pileup_feature, on=['contig', 'start_pos'])
     window_data = pd.merge(window_data, KAD_feature, on=['contig', 'start_pos'])
@@ -514,55 +672,128 @@ def cal_feature(options):
     window_data = window_data.fillna(0)
     window_data['coverage_diff'] = window_data['normalized_coverage'] - \
         window_data['normalized_fragment_coverage']
-    os.makedirs(os.path.join(options.output, "feature_matrix"), exist_ok=True)
-    window_data = window_data.loc[window_data['mean_coverage'] > 5, ]
-    window_data.to_csv(os.path.join(options.output, "feature_matrix/window_fea_matrix.txt"), sep="\t")
-    if options.mode == 'single':
-        return window_data
-    else:
-        contig_data = contig_fea_generate(window_data)
-        contig_data.to_csv(os.path.join(options.output,
-                                        "feature_matrix/contig_fea_matrix.txt"), sep="\t")
-        return window_data, contig_data
+    return window_data
 
 
-def feature_exist(options):
-    status = 1
-
-    def check_status(f):
-        if not os.path.exists(f):
-            nonlocal status
-            status = 0
-
-    check_status(os.path.join(options.output,
-                                       "temp/read_feature/read_feature.txt"))
-    check_status(os.path.join(options.output,
-                                       "temp/coverage/fragment_coverage.txt"))
-    check_status(os.path.join(options.output,
-                                       "temp/read_breakpoint/read_breakpoint_per_window.txt"))
-    check_status(os.path.join(options.output,
-                                       "temp/pileup/pileup_feature.txt"))
-    check_status(os.path.join(options.output,
-                                       "temp/KAD/KAD_window_data.txt"))
-
-    return status
+def cal_feature(options):
+    """
+    merge the window tables one chunk of contigs at a time, in the reference order in which
+    they are written, and write the window-based feature matrix as it is merged
+    """
+    tables = [os.path.join(options.output, "temp/read_feature/read_feature"),
+              os.path.join(options.output, "temp/coverage/fragment_coverage"),
+              os.path.join(options.output, "temp/pileup/pileup_feature"),
+              os.path.join(options.output, "temp/KAD/KAD_window_data"),
+              os.path.join(options.output, "temp/read_breakpoint/read_breakpoint_per_window")]
+    samfile = pysam.AlignmentFile(options.bamfile, "rb")
+    contig_id = pd.Series(np.arange(len(samfile.references)), index=list(samfile.references))
+
+    def window_chunks():
+        offset = 0
+        for chunks in window_table_chunks(tables, contig_id, options.feature_format):
+            window_data = window_merge(*chunks)
+            # row labels of the matrix merged at once
+            window_data.index = window_data.index + offset
+            offset += window_data.shape[0]
+            yield window_data.loc[window_data['mean_coverage'] > 5, ]
+
+    # matrices of an earlier run are removed first, so that an interrupted run leaves none behind
+    stage_start(options.output, "feature_matrix")
+    feature_discard(os.path.join(options.output, "feature_matrix/window_fea_matrix"))
+    feature_discard(os.path.join(options.output, "feature_matrix/contig_fea_matrix"))
+    os.makedirs(os.path.join(options.output, "feature_matrix"), exist_ok=True)
+    feature_write_chunks(window_chunks(), os.path.join(options.output, "feature_matrix/window_fea_matrix"),
+                         options.feature_format)
+    if options.mode != 'single':
+        # contig features are reduced from the stored matrix a chunk of whole contigs at a time,
+        # after one pass for the thresholds of abnormal windows
+        window_file = os.path.join(options.output, "feature_matrix/window_fea_matrix")
+        thresholds = window_thresholds(feature_chunks(window_file, options.feature_format))
+        contig_data = [contig_fea_generate(chunk, thresholds)
+                       for chunk in contig_chunks(feature_chunks(window_file, options.feature_format))]
+        contig_data = pd.concat(contig_data).sort_index() if contig_data else contig_fea_generate(pd.DataFrame())
+        feature_write(contig_data, os.path.join(options.output, "feature_matrix/contig_fea_matrix"), options.feature_format)
+    # predict and train read the matrices in the format recorded here
+    stage_done(options.output, "feature_matrix", stage_manifest([], {"feature_format": options.feature_format}))
+
+
+def matrix_format(options):
+    """
+    format of the feature matrices written by extract_feature, or None for matrices
+    written before it was recorded
+    """
+    return stage_params(options.output, "feature_matrix").get("feature_format")
 
 
 def check_feature(options):
+    # tables are only complete once the stages writing them have recorded their manifest
+    for stage in ["bam_feature", "KAD"] + (["pileup"] if options.pileup is not None else []):
+        if stage_key(options.output, stage) is None:
+            sys.stderr.write("Error: Feature extraction stage {} did not complete\n".format(stage))
+            sys.exit(1)
+
     def check_path(f):
-        if not os.path.exists(f):
-            sys.stderr.write("Error: Expected file {} does not exist\n".format(f))
+        if not feature_exists(f, options.feature_format):
+            sys.stderr.write("Error: Expected file {} does not exist\n".format(feature_path(f, options.feature_format)))
             sys.exit(1)
     check_path(os.path.join(options.output,
-                            "temp/read_feature/read_feature.txt"))
+                            "temp/read_feature/read_feature"))
     check_path(os.path.join(options.output,
-                            "temp/coverage/fragment_coverage.txt"))
+                            "temp/coverage/fragment_coverage"))
     check_path(os.path.join(options.output,
-                            "temp/read_breakpoint/read_breakpoint_per_window.txt"))
+                            "temp/read_breakpoint/read_breakpoint_per_window"))
     check_path(os.path.join(options.output,
-                            "temp/pileup/pileup_feature.txt"))
+                            "temp/pileup/pileup_feature"))
     check_path(os.path.join(options.output,
-                            "temp/KAD/KAD_window_data.txt"))
+                            "temp/KAD/KAD_window_data"))
+
+
+# flattened forests by model directory, reloaded when the pickles change
+model_cache = {}
+
+
+def model_stamp(model_path):
+    model_files = [os.path.join(model_path, "RF{}.pkl".format(i)) for i in range(10)]
+    for f in model_files:
+        if not os.path.exists(f):
+            sys.stderr.write("Error: Expected model file {} does not exist\n".format(f))
+            sys.exit(1)
+    return model_files, [[os.path.getsize(f), os.stat(f).st_mtime_ns] for f in model_files]
+
+
+def export_forest(model_path):
+    """
+    flatten the ten random forests of a model directory into model_path/forest,
+    recording the pickles it was built from; the pickles are only read here, with
+    their arrays memory-mapped, and are not kept once flattened
+    """
+    model_files, stamp = model_stamp(model_path)
+    forest = forest_flatten([joblib.load(f, mmap_mode='r') for f in model_files])
+    forest["source"] = stamp
+    try:
+        forest_write(forest, os.path.join(model_path, "forest"))
+    except OSError:
+        logging.getLogger('metaMIC').warning("Cannot write the flattened forest to {}".format(model_path))
+    return forest
+
+
+def load_forest(model_path):
+    """
+    flattened node arrays of the ten random forests of a model directory, memory-mapped
+    from model_path/forest and exported from the pickles when missing or out of date
+    """
+    model_path = os.path.abspath(model_path)
+    stamp = model_stamp(model_path)[1]
+    key = os.path.join(model_path, "forest")
+    if key not in model_cache or model_cache[key][0] != stamp:
+        try:
+            forest = forest_read(key)
+        except (OSError, ValueError):
+            forest = None
+        if forest is None or forest.get("source") != stamp:
+            forest = export_forest(model_path)
+        model_cache[key] = (stamp, forest)
+    return model_cache[key][1]
 
 
 def predict(options, data):
@@ -575,14 +806,21 @@ def predict(options, data):
         f = model_path
         sys.stderr.write("Error: Expected training model '{f}' does not exist\n")
         sys.exit(1)
-    score = pd.DataFrame(np.zeros([test_data.shape[0], 10]))
+    forest = load_forest(model_path)
+    if options.cascade and options.assembler in ['MEGAHIT', 'IDBA_UD']:
+        score = forest_cascade(forest, test_data, findcut(options, None), threads=options.threads)
+        skipped = np.isnan(score)
+        logging.getLogger('metaMIC').info(
+            "Cascaded scoring stopped early for {} of {} contigs, skipping {:.1%} of tree evaluations".format(
+                int(skipped.any(axis=1).sum()), score.shape[0],
+                (skipped * forest["model_trees"]).sum() / max(1, score.shape[0] * sum(forest["model_trees"]))))
+    else:
+        if options.cascade:
+            logging.getLogger('metaMIC').warning("Cascaded scoring needs the fixed score cutoff of the MEGAHIT or IDBA_UD model, scoring all contigs in full")
+        score = forest_predict(forest, test_data, threads=options.threads)
+    score = pd.DataFrame(score)
     score.index = test_data.index
-    for i in range(10):
-        rf = joblib.load(model_path + "/RF" + str(i) + '.pkl')
-        pro = pd.DataFrame(rf.predict_proba(test_data))
-        pro.index = test_data.index
-        score.loc[pro.index, i] = pro[1]
-    score['metaMIC_contig_score'] = score.mean(axis=1)
+    score['metaMIC_contig_score'] = score.mean(axis=1, skipna=False)
     score = score.loc[:, ['metaMIC_contig_score']]
     score['length'] = data.loc[score.index, 'length']
     os.makedirs(options.output, exist_ok=True)
@@ -602,6 +840,21 @@ def findcut(options, score):
     return score_cut
 
 
+worker_models = {}
+
+
+def iso_worker_init(models):
+    """
+    keep the fitted isolation forests once per worker process
+    """
+    worker_models["iso"] = models
+
+
+def iso_score(task):
+    start, x = task
+    return start, np.array([clf.score_samples(x) for clf in worker_models["iso"]])
+
+
 def Isolation_forest(options, window_data):
     """
     Isolation Forest
@@ -611,17 +864,31 @@ def Isolation_forest(options, window_data):
     Xdata = Xdata.replace(np.inf, 0)
     n_samples = Xdata.shape[0]
     if options.mode == 'meta':
-        iso_parameter = {"outlier_fraction": 0.001, "outlier_threshold": 0.01}
+        iso_parameter = {"outlier_fraction": 0.001, "outlier_threshold": 0.01, "max_samples": 256}
     else:
         iso_parameter = {
             "outlier_fraction": 0.0001,
-            "outlier_threshold": 0.001}
-    # fit the model
+            "outlier_threshold": 0.001,
+            "max_samples": 256}
+    # fit the models on subsamples with fixed seeds; the offset for the outlier fraction
+    # is taken from the scores of all windows below, so that fit does not score them too
+    X = Xdata.to_numpy(dtype=np.float32)
+    models = []
+    for i in range(5):
+        clf = IsolationForest(max_samples=min(iso_parameter["max_samples"], n_samples),
+                              contamination='auto', random_state=i, n_jobs=options.threads)
+        clf.fit(X)
+        models.append(clf.set_params(n_jobs=1))
+    scores = np.zeros([5, n_samples])
+    rows = max(1, min(1 << 16, -(-n_samples // (4 * options.threads))))
+    tasks = ((start, X[start:start + rows]) for start in range(0, n_samples, rows))
+    with multiprocessing.Pool(processes=options.threads, initializer=iso_worker_init, initargs=(models,)) as pool:
+        for start, chunk_scores in pool.imap_unordered(iso_score, tasks):
+            scores[:, start:start + chunk_scores.shape[1]] = chunk_scores
+    # decision_function of a model fitted with the outlier fraction as contamination
     score_pred = np.zeros([n_samples])
     for i in range(5):
-        clf = IsolationForest(contamination=iso_parameter["outlier_fraction"])
-        clf.fit(Xdata)
-        score_pred += clf.decision_function(Xdata)
+        score_pred += scores[i] - np.percentile(scores[i], 100.0 * iso_parameter["outlier_fraction"])
     score_pred = score_pred / 5
     Xdata['anomaly_score'] = 1 - score_pred
     threshold = stats.scoreatpercentile(
@@ -636,26 +903,36 @@ def Isolation_forest(options, window_data):
     return score_pred_data
 
 
+def read_breakpoint_load(read_breakpoint_file, contigs, fmt=None):
+    """
+    per-base read breakpoints of the given contigs with the start of their 100bp window
+    """
+    if base_store_exists(read_breakpoint_file):
+        read_breakpoint = base_store_read(read_breakpoint_file, contigs)
+    else:
+        read_breakpoint = feature_read(read_breakpoint_file, fmt)
+        read_breakpoint = read_breakpoint.loc[read_breakpoint['contig'].isin(set(contigs)), ]
+    read_breakpoint['start_pos'] = ((read_breakpoint['position'] - 300) / 100).astype(int) * 100 + 300
+    return read_breakpoint
+
+
 def breakpoint_detect(options, data):
     """
     Localize misassembly breakpoints in single genomic/metagenomic assemblies
     """
-    if not os.path.exists(os.path.join(options.output,
-                                       "temp/read_breakpoint/read_breakpoint_per_base.txt")):
-        f = os.path.join(options.output,
-                                       "temp/read_breakpoint/read_breakpoint_per_base.txt")
-        sys.stderr.write("Error: Expected file {} does not exist\n".format(f))
+    read_breakpoint_file = os.path.join(options.output, "temp/read_breakpoint/read_breakpoint_per_base")
+    fmt = stage_params(options.output, "bam_feature").get("feature_format")
+    if not base_store_exists(read_breakpoint_file) and not feature_exists(read_breakpoint_file, fmt):
+        sys.stderr.write("Error: Expected file {} does not exist\n".format(read_breakpoint_file))
         sys.exit(1)
 
-    read_breakpoint = pd.read_csv(os.path.join(options.output,
-                                               "temp/read_breakpoint/read_breakpoint_per_base.txt"), sep="\t", index_col=0)
-    read_breakpoint['start_pos'] = [int(x) * 100 + 300 for x in list((read_breakpoint['position'] - 300) / 100)]
     data.index = data['contig'] + "_" + [str(int(x)) for x in data['start_pos']]
     if options.mode == "single":
         score_pred_data = Isolation_forest(options, data)
         score_pred_data.to_csv(options.output + "/anomaly_score.txt", sep="\t")
         score_pred_data = score_pred_data.loc[score_pred_data['anomaly_score'] > 0.95, ]
         score_pred_data.index = range(score_pred_data.shape[0])
+        read_breakpoint = read_breakpoint_load(read_breakpoint_file, score_pred_data['contig'], fmt)
         result = pd.merge(
             read_breakpoint, score_pred_data, on=[
                 'contig', 'start_pos'])
@@ -708,6 +985,7 @@ def breakpoint_detect(options, data):
         score_pred_data = score_pred_data.drop_duplicates(['contig'], keep='first')
         contig_breakpoints = score_pred_data.loc[:, ['contig', 'start_pos', 'anomaly_score',
                                                      'anomaly_thred', 'read_breakpoint_ratio']]
+        read_breakpoint = read_breakpoint_load(read_breakpoint_file, contig_breakpoints['contig'], fmt)
         result = pd.merge(read_breakpoint, contig_breakpoints, on=['contig', 'start_pos'], how='right')
         result['read_breakpoint_count'] = result['read_breakpoint_count'].fillna(0)
         result['position'] = result['position'].fillna(0)
@@ -775,7 +1053,8 @@ def correct(options, breakpoint_result):
 
 from .train import train
 def train_model(options, data):
-    train(data, options)
+    train(data, options, matrix_format(options))
+    export_forest(os.path.join(base_path, 'model', options.assembler))
 
 
 def bamindex(options):
@@ -800,13 +1079,13 @@ def validate_options(options):
             os.makedirs(options.output, exist_ok=True)
 
     if options.cmd == 'extract_feature':
-        if os.path.exists(os.path.join(options.output, "temp/contig/filtered_contigs.fa")):
-            options.assemblies = os.path.join(options.output, "temp/contig/filtered_contigs.fa")
-        else:
-            expect_file(options.assemblies)
-            options = filter_contig(options)
+        expect_file(options.assemblies)
+        options = filter_contig(options)
         expect_file(options.pileup)
         expect_mode(options.mode)
+        if not format_available(options.feature_format):
+            sys.stderr.write("Error: feature format {} requires pyarrow\n".format(options.feature_format))
+            sys.exit(1)
         if options.bamfile is not None:
             expect_file(options.bamfile)
             bamindex(options)
@@ -845,11 +1124,8 @@ def validate_options(options):
             sys.exit(1)
 
     if options.cmd == 'predict':
-        if os.path.exists(os.path.join(options.output, "temp/contig/filtered_contigs.fa")):
-            options.assemblies = os.path.join(options.output, "temp/contig/filtered_contigs.fa")
-        else:
-            expect_file(options.assemblies)
-            options = filter_contig(options)
+        expect_file(options.assemblies)
+        options = filter_contig(options)
 
         expect_mode(options.mode)
     return options
@@ -882,7 +1158,7 @@ def main():
     if options.cmd == 'train':
         logger.info('Step: Training new models')
 
-        train_model(options, os.path.join(options.output, 'feature_matrix/contig_fea_matrix.txt'))
+        train_model(options, os.path.join(options.output, 'feature_matrix/contig_fea_matrix'))
         logger.info("Finished")
         return 0
 
@@ -890,11 +1166,13 @@ def main():
     if options.cmd == 'predict':
         if options.mode == 'meta':
             logger.info('Step: Identify misassembled metagenomic contigs')
-            contig_data = pd.read_csv(os.path.join(options.output, 'feature_matrix/contig_fea_matrix.txt'), sep="\t", index_col=0)
+            contig_data = feature_read(os.path.join(options.output, 'feature_matrix/contig_fea_matrix'),
+                                       matrix_format(options))
             score = predict(options, contig_data)
 
         logger.info('Step: Localize misassembly breakpoints')
-        window_data = pd.read_csv(os.path.join(options.output, 'feature_matrix/window_fea_matrix.txt'), sep="\t", index_col=0)
+        window_data = feature_read(os.path.join(options.output, 'feature_matrix/window_fea_matrix'),
+                                   matrix_format(options))
         breakpoint_result = breakpoint_detect(options, window_data)
         logger.info('Step: Correct misassemblies')
         correct(options, breakpoint_result)
@@ -0,0 +1,395 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import uuid
+import zipfile
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FEATURE_FORMATS = {"npz": ".npz", "parquet": ".parquet", "tsv": ".txt"}
+
+
+def atomic_write(path, write):
+    """
+    call write(tmp) on a temporary path next to path and rename it over path once it has
+    been written completely, so that an interrupted run never leaves a truncated output
+    """
+    tmp = "{}.tmp{}".format(path, os.getpid())
+    try:
+        write(tmp)
+        if os.path.isdir(tmp) and os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def savez_atomic(path, compressed=False, **arrays):
+    """
+    np.savez/np.savez_compressed to path through atomic_write
+    """
+    def write(tmp):
+        with open(tmp, "wb") as f:
+            (np.savez_compressed if compressed else np.savez)(f, **arrays)
+    atomic_write(path, write)
+
+
+def format_available(fmt):
+    return fmt != "parquet" or pyarrow is not None
+
+
+def feature_path(path, fmt):
+    """
+    file of a feature table stored in fmt, with path given without extension
+    """
+    return path + FEATURE_FORMATS[fmt]
+
+
+def feature_file(path, fmt=None):
+    """
+    existing file of a feature table in format fmt, or None; without fmt, the first
+    existing file in any format, for tables written before their format was recorded
+    """
+    for f in [fmt] if fmt is not None else FEATURE_FORMATS:
+        if os.path.exists(feature_path(path, f)):
+            return feature_path(path, f)
+    return None
+
+
+def feature_exists(path, fmt=None):
+    return feature_file(path, fmt) is not None
+
+
+def feature_discard(path, fmt=None):
+    """
+    remove the files of a feature table in the formats other than fmt, or in every format
+    without fmt, so that a table written again in another format never leaves a stale copy behind
+    """
+    for f in FEATURE_FORMATS:
+        if f != fmt and os.path.exists(feature_path(path, f)):
+            os.remove(feature_path(path, f))
+
+
+def feature_columns(data, float32=True):
+    """
+    columns of a feature table as stored in the binary formats: float features as float32
+    unless float32 is False, and string columns such as contig dictionary-encoded
+    """
+    columns = {}
+    for col in data.columns:
+        values = data[col]
+        if float32 and pd.api.types.is_float_dtype(values):
+            values = values.astype(np.float32)
+        elif not pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            values = values.astype(str).astype("category")
+        columns[col] = values
+    return columns
+
+
+def feature_write(data, path, fmt="npz", float32=True):
+    """
+    write a feature table as compressed npz, parquet, or tab-separated text with the
+    index as its first column; float32 applies to the binary formats only
+    """
+    feature_discard(path, fmt)
+    if fmt == "tsv":
+        atomic_write(feature_path(path, fmt), lambda tmp: data.to_csv(tmp, sep="\t"))
+        return
+    columns = feature_columns(data, float32)
+    if fmt == "parquet":
+        atomic_write(feature_path(path, fmt),
+                     lambda tmp: pd.DataFrame(columns, index=data.index).to_parquet(tmp, compression="zstd"))
+        return
+    if pd.api.types.is_numeric_dtype(data.index):
+        index = np.asarray(data.index)
+    else:
+        index = np.asarray(data.index, dtype=str)
+    arrays = {"__columns__": np.array(list(columns), dtype=str),
+              "__index__": index,
+              "__index_name__": np.array([data.index.name or ""], dtype=str)}
+    for i, (col, values) in enumerate(columns.items()):
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            arrays["codes_{}".format(i)] = values.cat.codes.values
+            arrays["categories_{}".format(i)] = np.array(values.cat.categories, dtype=str)
+        else:
+            arrays["values_{}".format(i)] = np.asarray(values)
+    savez_atomic(feature_path(path, fmt), compressed=True, **arrays)
+
+
+def feature_read(path, fmt=None):
+    """
+    read a feature table written by feature_write in format fmt, see feature_file;
+    dictionary-encoded columns are returned as plain strings
+    """
+    f = feature_file(path, fmt)
+    if f is None:
+        f = feature_path(path, fmt or "tsv")
+    if f.endswith(FEATURE_FORMATS["tsv"]):
+        return pd.read_csv(f, sep="\t", index_col=0)
+    if f.endswith(FEATURE_FORMATS["parquet"]):
+        data = pd.read_parquet(f)
+        for col in data.columns:
+            if isinstance(data[col].dtype, pd.CategoricalDtype):
+                data[col] = data[col].astype(str)
+        return data
+    with np.load(f) as arrays:
+        columns = {}
+        for i, col in enumerate(arrays["__columns__"]):
+            if "codes_{}".format(i) in arrays:
+                columns[str(col)] = arrays["categories_{}".format(i)].astype(object)[arrays["codes_{}".format(i)]]
+            else:
+                columns[str(col)] = arrays["values_{}".format(i)]
+        index = arrays["__index__"]
+        index = pd.Index(index.astype(object) if index.dtype.kind == "U" else index,
+                         name=str(arrays["__index_name__"][0]) or None)
+    return pd.DataFrame(columns, index=index)
+
+
+def npy_chunks(archive, name, chunk_size):
+    """
+    consecutive chunks of a one-dimensional array stored as name.npy in an npz archive,
+    decompressed incrementally; an empty array gives one empty chunk
+    """
+    with archive.open(name + ".npy") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        for start in range(0, max(shape[0], 1), chunk_size):
+            count = min(chunk_size, shape[0] - start)
+            yield np.frombuffer(f.read(count * dtype.itemsize), dtype=dtype, count=count)
+
+
+def feature_chunks(path, fmt=None, chunk_size=1 << 20):
+    """
+    consecutive row chunks of a feature table written by feature_write in format fmt, read
+    incrementally so that the whole table is never held in memory
+    """
+    f = feature_file(path, fmt)
+    if f is None:
+        f = feature_path(path, fmt or "tsv")
+    if f.endswith(FEATURE_FORMATS["tsv"]):
+        yield from pd.read_csv(f, sep="\t", index_col=0, chunksize=chunk_size)
+        return
+    if f.endswith(FEATURE_FORMATS["parquet"]):
+        parquet = pyarrow.parquet.ParquetFile(f)
+        for batch in parquet.iter_batches(batch_size=chunk_size):
+            data = pyarrow.Table.from_batches([batch], schema=parquet.schema_arrow).to_pandas()
+            for col in data.columns:
+                if isinstance(data[col].dtype, pd.CategoricalDtype):
+                    data[col] = data[col].astype(str)
+            yield data
+        return
+    with np.load(f) as arrays:
+        columns = [str(col) for col in arrays["__columns__"]]
+        index_name = str(arrays["__index_name__"][0]) or None
+        categories = {i: arrays["categories_{}".format(i)].astype(object)
+                      for i in range(len(columns)) if "categories_{}".format(i) in arrays}
+    with zipfile.ZipFile(f) as archive:
+        index_chunks = npy_chunks(archive, "__index__", chunk_size)
+        column_chunks = [npy_chunks(archive, "codes_{}".format(i) if i in categories else "values_{}".format(i),
+                                    chunk_size) for i in range(len(columns))]
+        for index in index_chunks:
+            data = {}
+            for i, col in enumerate(columns):
+                values = next(column_chunks[i])
+                data[col] = categories[i][values] if i in categories else values
+            yield pd.DataFrame(data, index=pd.Index(index.astype(object) if index.dtype.kind == "U" else index,
+                                                    name=index_name))
+
+
+def feature_write_chunks(chunks, path, fmt="npz"):
+    """
+    write a feature table given as consecutive row chunks in the layout of feature_write,
+    holding one chunk in memory at a time; the npz columns are spilled to disk until
+    their length is known
+    """
+    feature_discard(path, fmt)
+    if fmt == "tsv":
+        def write(tmp):
+            with open(tmp, "w") as f:
+                for i, chunk in enumerate(chunks):
+                    chunk.to_csv(f, sep="\t", header=i == 0)
+        atomic_write(feature_path(path, fmt), write)
+        return
+    if fmt == "parquet":
+        def write(tmp):
+            writer = None
+            for chunk in chunks:
+                table = pyarrow.Table.from_pandas(pd.DataFrame(feature_columns(chunk), index=chunk.index),
+                                                  preserve_index=True)
+                if writer is None:
+                    writer = pyarrow.parquet.ParquetWriter(tmp, table.schema, compression="zstd")
+                writer.write_table(table)
+            if writer is not None:
+                writer.close()
+        atomic_write(feature_path(path, fmt), write)
+        return
+
+    def write(tmp):
+        spill = tmp + ".columns"
+        os.makedirs(spill)
+        try:
+            columns = []
+            index_name = ""
+            categories = {}
+            spill_files = {}
+            dtypes = {}
+            nrows = 0
+            for chunk in chunks:
+                if not pd.api.types.is_numeric_dtype(chunk.index):
+                    raise ValueError("chunked npz feature tables need a numeric index")
+                chunk_columns = feature_columns(chunk)
+                columns = list(chunk_columns)
+                index_name = chunk.index.name or ""
+                arrays = {"__index__": np.asarray(chunk.index)}
+                for i, values in enumerate(chunk_columns.values()):
+                    if isinstance(values.dtype, pd.CategoricalDtype):
+                        # codes of a chunk are mapped to categories shared by all chunks
+                        codes = categories.setdefault(i, {})
+                        mapping = np.array([codes.setdefault(c, len(codes)) for c in values.cat.categories] + [-1],
+                                           dtype=np.int64)
+                        arrays["codes_{}".format(i)] = mapping[values.cat.codes.values]
+                    else:
+                        arrays["values_{}".format(i)] = np.asarray(values)
+                for key, values in arrays.items():
+                    if key not in spill_files:
+                        spill_files[key] = open(os.path.join(spill, key), "wb")
+                        dtypes[key] = values.dtype
+                    spill_files[key].write(np.ascontiguousarray(values, dtype=dtypes[key]).tobytes())
+                nrows += len(chunk)
+            for spill_file in spill_files.values():
+                spill_file.close()
+
+            with zipfile.ZipFile(tmp, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+                small = {"__columns__": np.array(columns, dtype=str),
+                         "__index_name__": np.array([index_name], dtype=str)}
+                for i, codes in categories.items():
+                    small["categories_{}".format(i)] = np.array(list(codes), dtype=str)
+                for key, values in small.items():
+                    with archive.open(key + ".npy", "w", force_zip64=True) as f:
+                        np.lib.format.write_array(f, values)
+                for key, dtype in dtypes.items():
+                    with archive.open(key + ".npy", "w", force_zip64=True) as f:
+                        np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(dtype),
+                                                                 "fortran_order": False, "shape": (nrows,)})
+                        with open(os.path.join(spill, key), "rb") as spill_file:
+                            shutil.copyfileobj(spill_file, f)
+        finally:
+            shutil.rmtree(spill)
+    atomic_write(feature_path(path, fmt), write)
+
+
+def base_store_exists(path):
+    return os.path.exists(os.path.join(path, "offset.npy"))
+
+
+def base_store_write(data, path):
+    """
+    write a per-base table with the rows of each contig together as one .npy file per
+    column under the directory path, indexed by contig offsets
+    """
+    contig = np.asarray(data["contig"], dtype=str)
+    starts = np.concatenate([[0], np.flatnonzero(contig[1:] != contig[:-1]) + 1]) if len(contig) > 0 \
+        else np.zeros(0, dtype=np.int64)
+    columns = [col for col in data.columns if col != "contig"]
+
+    def write(tmp):
+        os.makedirs(tmp)
+        for col in columns:
+            np.save(os.path.join(tmp, "{}.npy".format(col)), np.asarray(data[col]))
+        np.save(os.path.join(tmp, "columns.npy"), np.array(columns, dtype=str))
+        np.save(os.path.join(tmp, "contig.npy"), contig[starts])
+        np.save(os.path.join(tmp, "offset.npy"), np.append(starts, len(contig)))
+    atomic_write(path, write)
+
+
+def base_store_read(path, contigs):
+    """
+    rows of the given contigs, sliced from the memory-mapped columns of a per-base store
+    """
+    names = np.load(os.path.join(path, "contig.npy"))
+    offset = np.load(os.path.join(path, "offset.npy"))
+    index = {name: i for i, name in enumerate(names)}
+    selected = sorted(index[contig] for contig in set(contigs) if contig in index)
+    data = {"contig": np.repeat(names[selected], offset[1:][selected] - offset[:-1][selected]).astype(object)}
+    for col in np.load(os.path.join(path, "columns.npy")):
+        values = np.load(os.path.join(path, "{}.npy".format(col)), mmap_mode="r")
+        data[str(col)] = np.concatenate([values[:0]] + [values[offset[i]:offset[i + 1]] for i in selected])
+    return pd.DataFrame(data)
+
+
+def contig_store_done(path):
+    """
+    part holding the results of every contig in the completion log of a contig store;
+    a contig logged more than once is taken from its last part
+    """
+    done = {}
+    log = os.path.join(path, "done.log")
+    if not os.path.exists(log):
+        return done
+    with open(log) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            # a line cut short by an interrupted run has no newline or is merged with the next one
+            if line.endswith("\n") and len(fields) == 2:
+                done[fields[0]] = fields[1]
+    return done
+
+
+def contig_store_part():
+    return uuid.uuid4().hex
+
+
+def contig_store_log(path, contigs, part):
+    """
+    append contigs to the completion log of a contig store, with results in part
+    """
+    with open(os.path.join(path, "done.log"), "a") as f:
+        f.write("".join("{}\t{}\n".format(contig, part) for contig in contigs))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def contig_store_append(path, contigs, tables, float32=True):
+    """
+    write the feature tables of a batch of contigs as a new part of a contig store and
+    log the contigs as completed once all of them are in place; without float32, float
+    features keep their precision for tables that end up as text
+    """
+    part = contig_store_part()
+    for name, data in tables.items():
+        os.makedirs(os.path.join(path, name), exist_ok=True)
+        feature_write(data, os.path.join(path, name, part), float32=float32)
+    contig_store_log(path, contigs, part)
+
+
+def contig_store_read(path, name, contigs, columns):
+    """
+    feature table name of the given contigs gathered from the parts of a contig store,
+    with the rows of each contig in the order of contigs
+    """
+    done = contig_store_done(path)
+    rank = {contig: i for i, contig in enumerate(contigs)}
+    owner = pd.Series(done, dtype=object)
+    frames = []
+    for part in sorted(set(done[contig] for contig in contigs if contig in done)):
+        data = feature_read(os.path.join(path, name, part), "npz")
+        frames.append(data.loc[(data["contig"].map(owner) == part).values & data["contig"].isin(rank).values])
+    if not frames:
+        return pd.DataFrame({col: [] for col in columns})
+    data = pd.concat(frames, ignore_index=True)
+    order = np.argsort(data["contig"].map(rank).values, kind="stable")
+    return data.iloc[order].reset_index(drop=True)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+WINDOW_SIZE = 100
+EDGE_SIZE = 300
+
+
+def window_starts(length, tail=True):
+    """
+    start positions of 100bp windows skipping the first 300bp of a contig;
+    with tail, stop after the first window ending within 300bp of the contig end
+    """
+    starts = np.arange(EDGE_SIZE, length, WINDOW_SIZE)
+    if tail:
+        last = np.flatnonzero(length - (starts + WINDOW_SIZE) <= EDGE_SIZE)
+        if len(last) > 0:
+            starts = starts[:last[0] + 1]
+    return starts
+
+
+def window_reduce(values, starts, func):
+    """
+    reduce every window of a per-base track with func(array, axis=1) in one batch
+    """
+    values = np.asarray(values, dtype=float)
+    ends = np.minimum(starts + WINDOW_SIZE, len(values))
+    result = np.empty(len(starts))
+    # only the trailing windows can be shorter than WINDOW_SIZE
+    nfull = int(np.sum(ends - starts == WINDOW_SIZE))
+    if nfull > 0:
+        block = values[starts[0]:starts[0] + nfull * WINDOW_SIZE].reshape(nfull, WINDOW_SIZE)
+        result[:nfull] = func(block, axis=1)
+    for i in range(nfull, len(starts)):
+        result[i] = func(values[starts[i]:ends[i]].reshape(1, -1), axis=1)[0]
+    return result
+
+
+def window_sum(values, starts):
+    return window_reduce(values, starts, np.sum)
+
+
+def window_mean(values, starts):
+    return window_reduce(values, starts, np.mean)
+
+
+def window_var(values, starts):
+    return window_reduce(values, starts, np.var)
+
+
+def coverage_track(starts, ends, length):
+    """
+    per-base coverage of [start, end) intervals, accumulated as start/end events
+    and resolved with a single cumulative sum
+    """
+    starts = np.clip(np.asarray(starts, dtype=np.int64), 0, length)
+    ends = np.clip(np.asarray(ends, dtype=np.int64), 0, length)
+    keep = ends > starts
+    events = np.bincount(starts[keep], minlength=length + 1) - \
+        np.bincount(ends[keep], minlength=length + 1)
+    return np.cumsum(events[:length]).astype(np.uint32)